@@ -0,0 +1,291 @@
+"""offline benchmarks for the kdf, crypto, stego and vault paths
+
+    python benchmarks/bench.py run --out results.json
+    python benchmarks/bench.py run --full --out results.json
+    python benchmarks/bench.py run --only crypto vault --check
+    python benchmarks/bench.py compare baseline.json results.json
+
+run writes one json file with per case timings, compare flags every case
+whose median got slower than the baseline by more than --threshold. the
+alloc/ cases are the peak bytes tracemalloc sees during one call, flagged
+the same way when they grow. they also have fixed budgets (ALLOC_BUDGETS),
+run --check exits 1 when one is exceeded, no baseline needed.
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np
+from PIL import Image
+from vaultic import passgen, stego
+from vaultic.vault import Vault, VaultPaths, derive_key, encrypt_json, decrypt_json, seal, unseal
+
+QUICK = {
+    "megapixels": [0.1, 1, 4],
+    "entries": [10, 1000],
+    "pixel_megapixels": [0.1, 1],
+    "repeat": 5,
+}
+FULL = {
+    "megapixels": [0.1, 1, 4, 12, 24],
+    "entries": [10, 1000, 10_000, 100_000],
+    "pixel_megapixels": [0.1, 1, 12],
+    "repeat": 7,
+}
+
+# peak bytes allowed per alloc/ case: fixed + per_item * n, n being the last
+# part of the case name (entries sealed or in the vault). roughly 1.5x what
+# they measured when the budgets were set
+ALLOC_BUDGETS = {
+    "alloc/crypto/seal": (64 * 1024, 512),
+    "alloc/crypto/unseal": (48 * 1024, 512),
+    "alloc/vault/get_entry": (48 * 1024, 0),
+    "alloc/vault/get_entry_uncached": (64 * 1024, 1536),
+    "alloc/vault/add_entry": (96 * 1024, 128),
+}
+
+
+def timeit(fn: Callable[[], object], repeat: int, setup: Optional[Callable[[], object]] = None) -> Dict:
+    runs = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return {"min": min(runs), "median": statistics.median(runs), "runs": len(runs)}
+
+
+# peak python heap growth during one call, after a warm-up call so lazily
+# built tables and caches don't count, nor does tracemalloc's own bookkeeping
+def allocs(fn: Callable[[], object], setup: Optional[Callable[[], object]] = None) -> Dict:
+    fn()
+    tracemalloc.start()
+    try:
+        if setup:
+            setup()
+        start, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"value": peak - start}
+
+
+# smooth gradient plus a little noise, compresses roughly like a photo
+def make_cover(path: Path, megapixels: float) -> Path:
+    side = int((megapixels * 1_000_000) ** 0.5)
+    w, h = int(side * 4 / 3), int(side * 3 / 4)
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:h, 0:w]
+    img = np.stack([(x * 255 // max(w, 1)), (y * 255 // max(h, 1)), ((x + y) * 255 // max(w + h, 1))], axis=-1)
+    img = (img + rng.integers(0, 8, img.shape)).clip(0, 255).astype(np.uint8)
+    Image.fromarray(img).save(path, format="PNG", compress_level=1)
+    return path
+
+
+def make_vault(base: Path, cover: Path, entries: int) -> Vault:
+    base.mkdir(parents=True, exist_ok=True)
+    paths = VaultPaths(dir=base, vault_file=base / "vault.png", salt_file=base / "salt.bin")
+    vault = Vault("benchmark", paths=paths)
+    vault.create_meme(cover)
+    with vault.batch() as tx:
+        for i in range(entries):
+            tx.add(f"service-{i:06d}.example.com", f"password-{i:06d}-xxxxxxxx")
+    return vault
+
+
+def bench_kdf(results: Dict, cfg: Dict) -> None:
+    salt = os.urandom(16)
+    results["kdf/derive_key"] = timeit(lambda: derive_key("benchmark", salt), cfg["repeat"])
+
+
+def bench_crypto(results: Dict, cfg: Dict) -> None:
+    key = os.urandom(32)
+    for n in cfg["entries"]:
+        data = {"entries": {f"service-{i:06d}": {"password": f"password-{i:06d}"} for i in range(n)}}
+        blob = encrypt_json(data, key)
+        results[f"crypto/encrypt_json/{n}"] = timeit(lambda: encrypt_json(data, key), cfg["repeat"])
+        results[f"crypto/decrypt_json/{n}"] = timeit(lambda: decrypt_json(blob, key), cfg["repeat"])
+        sealed = seal(data, key, b"bench")
+        results[f"crypto/seal/{n}"] = timeit(lambda: seal(data, key, b"bench"), cfg["repeat"])
+        results[f"crypto/unseal/{n}"] = timeit(lambda: unseal(sealed, key, b"bench"), cfg["repeat"])
+        results[f"alloc/crypto/seal/{n}"] = allocs(lambda: seal(data, key, b"bench"))
+        results[f"alloc/crypto/unseal/{n}"] = allocs(lambda: unseal(sealed, key, b"bench"))
+
+
+def bench_stego(results: Dict, cfg: Dict, tmp: Path) -> None:
+    blob = os.urandom(64 * 1024)
+    seed = os.urandom(32)
+    for mp in cfg["megapixels"]:
+        cover = make_cover(tmp / f"cover-{mp}.png", mp)
+        out = tmp / f"out-{mp}.png"
+        results[f"stego/embed/{mp}mp"] = timeit(lambda: stego.embed(cover, blob, out), cfg["repeat"])
+        results[f"stego/extract/{mp}mp"] = timeit(lambda: stego.extract(out), cfg["repeat"])
+    for mp in cfg["pixel_megapixels"]:
+        cover = tmp / f"cover-{mp}.png"
+        if not cover.exists():
+            make_cover(cover, mp)
+        out = tmp / f"pixels-{mp}.png"
+        small = blob[: min(len(blob), stego.capacity(cover))]
+        results[f"stego/embed_pixels/{mp}mp"] = timeit(lambda: stego.embed_pixels(cover, small, out, seed), cfg["repeat"])
+        results[f"stego/extract_pixels/{mp}mp"] = timeit(lambda: stego.extract_pixels(out, seed), cfg["repeat"])
+
+
+def bench_vault(results: Dict, cfg: Dict, tmp: Path) -> None:
+    cover = make_cover(tmp / "vault-cover.png", 1)
+    for n in cfg["entries"]:
+        vault = make_vault(tmp / f"vault-{n}", cover, n)
+        probe = f"service-{n // 2:06d}.example.com"
+        r = cfg["repeat"]
+        results[f"vault/list_services/{n}"] = timeit(vault.list_services, r)
+        results[f"vault/get_entry/{n}"] = timeit(lambda: vault.get_entry(probe), r)
+        results[f"vault/get_entry_uncached/{n}"] = timeit(lambda: vault.get_entry(probe), r, setup=vault.cache.invalidate)
+        results[f"vault/add_entry/{n}"] = timeit(lambda: vault.add_entry("bench-new", "secret"), r)
+        results[f"vault/delete_entry/{n}"] = timeit(
+            lambda: vault.delete_entry("bench-new"), r, setup=lambda: vault.add_entry("bench-new", "secret")
+        )
+        results[f"alloc/vault/get_entry/{n}"] = allocs(lambda: vault.get_entry(probe))
+        results[f"alloc/vault/get_entry_uncached/{n}"] = allocs(lambda: vault.get_entry(probe), setup=vault.cache.invalidate)
+        results[f"alloc/vault/add_entry/{n}"] = allocs(lambda: vault.add_entry("bench-new", "secret"))
+        # small batches land in the journal, fold them in so the image holds every entry
+        vault.compact()
+        results[f"vault/size_bytes/{n}"] = {"value": len(stego.extract(vault.paths.vault_file) or b"")}
+        # one change folded into the image, then the same over 8 shard images
+        change = lambda: vault.add_entry("bench-new", "secret")
+        results[f"vault/compact/{n}"] = timeit(vault.compact, r, setup=change)
+        results[f"vault/read_uncached/{n}"] = timeit(vault.list_services, r, setup=vault.cache.invalidate)
+        vault.reshard(8)
+        results[f"vault/compact_sharded/{n}"] = timeit(vault.compact, r, setup=change)
+        results[f"vault/read_uncached_sharded/{n}"] = timeit(vault.list_services, r, setup=vault.cache.invalidate)
+
+
+def bench_passgen(results: Dict, cfg: Dict) -> None:
+    policy = passgen.Policy(length=20)
+    for n in (1, 1000):
+        results[f"passgen/passwords/{n}"] = timeit(lambda: passgen.passwords(policy, n), cfg["repeat"])
+        results[f"passgen/passphrases/{n}"] = timeit(lambda: passgen.passphrases(6, n), cfg["repeat"])
+
+
+SUITES = {
+    "kdf": lambda results, cfg, tmp: bench_kdf(results, cfg),
+    "crypto": lambda results, cfg, tmp: bench_crypto(results, cfg),
+    "passgen": lambda results, cfg, tmp: bench_passgen(results, cfg),
+    "stego": bench_stego,
+    "vault": bench_vault,
+}
+
+
+def run(args: argparse.Namespace) -> int:
+    cfg = dict(FULL if args.full else QUICK)
+    if args.repeat:
+        cfg["repeat"] = args.repeat
+    suites = args.only or list(SUITES)
+    results: Dict = {}
+    with tempfile.TemporaryDirectory(prefix="vaultic-bench-") as tmp:
+        for name in suites:
+            start = time.perf_counter()
+            SUITES[name](results, cfg, Path(tmp))
+            print(f"{name}: {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "profile": "full" if args.full else "quick",
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.out:
+        Path(args.out).write_text(text + "\n")
+    else:
+        print(text)
+    for name, r in sorted(results.items()):
+        if "median" in r:
+            print(f"{name:40s} {r['median'] * 1000:10.3f} ms", file=sys.stderr)
+        else:
+            print(f"{name:40s} {r['value']:10d}", file=sys.stderr)
+    if args.check:
+        over = over_budget(results)
+        for line in over:
+            print(f"OVER BUDGET {line}", file=sys.stderr)
+        if over:
+            return 1
+    return 0
+
+
+def over_budget(results: Dict) -> List[str]:
+    over = []
+    for name, r in sorted(results.items()):
+        case, _, n = name.rpartition("/")
+        if case not in ALLOC_BUDGETS:
+            continue
+        fixed, per_item = ALLOC_BUDGETS[case]
+        budget = fixed + per_item * int(n)
+        if r["value"] > budget:
+            over.append(f"{name}: {r['value']} bytes, budget {budget}")
+    return over
+
+
+def compare(args: argparse.Namespace) -> int:
+    base = json.loads(Path(args.baseline).read_text())["results"]
+    new = json.loads(Path(args.results).read_text())["results"]
+    regressions: List[str] = []
+    for name in sorted(set(base) & set(new)):
+        key = "median" if "median" in base[name] else "value"
+        old_v, new_v = base[name][key], new[name][key]
+        ratio = new_v / old_v if old_v else 1.0
+        flag = ""
+        if ratio > 1 + args.threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 - args.threshold:
+            flag = "  faster"
+        print(f"{name:40s} {old_v:12.6g} -> {new_v:12.6g}  x{ratio:5.2f}{flag}")
+    for name in sorted(set(new) - set(base)):
+        print(f"{name:40s} (new)")
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_run = sub.add_parser("run", help="run the benchmarks")
+    p_run.add_argument("--full", action="store_true", help="covers up to 24 MP and vaults up to 100k entries")
+    p_run.add_argument("--only", nargs="+", choices=list(SUITES), help="run only these suites")
+    p_run.add_argument("--repeat", type=int, help="runs per case")
+    p_run.add_argument("--out", help="write results json here instead of stdout")
+    p_run.add_argument("--check", action="store_true", help="exit 1 when an alloc/ case goes past its ALLOC_BUDGETS entry")
+    p_run.set_defaults(fn=run)
+
+    p_cmp = sub.add_parser("compare", help="compare results against a baseline")
+    p_cmp.add_argument("baseline")
+    p_cmp.add_argument("results")
+    p_cmp.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown, 0.2 = 20%%")
+    p_cmp.set_defaults(fn=compare)
+
+    args = parser.parse_args(argv)
+    return args.fn(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,36 @@
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from vaultic.kdf import KdfParams
+from vaultic.vault import Vault, VaultPaths
+
+MASTER = "correct horse"
+# far below anything real, scrypt would otherwise dominate every test
+FAST_KDF = KdfParams(n=2**10, r=8, p=1)
+
+
+@pytest.fixture
+def cover(tmp_path: Path) -> Path:
+    path = tmp_path / "cover.png"
+    Image.new("RGB", (300, 300), "white").save(path)
+    return path
+
+
+@pytest.fixture
+def paths(tmp_path: Path) -> VaultPaths:
+    base = tmp_path / "vault"
+    return VaultPaths(dir=base, vault_file=base / "vault.png", salt_file=base / "salt.bin")
+
+
+@pytest.fixture
+def vault(paths: VaultPaths, cover: Path) -> Vault:
+    vault = Vault(MASTER, paths=paths, kdf=FAST_KDF)
+    vault.create_meme(cover)
+    return vault
+
+
+# another process's view of the same files: its own key and cache
+def reopen(vault: Vault) -> Vault:
+    return Vault(MASTER, paths=vault.paths)
@@ -0,0 +1,14 @@
+import bench
+
+
+# the quick profile's sizes, timings are skipped so this stays fast
+CFG = {"entries": [10, 1000], "repeat": 1}
+
+
+def test_alloc_budgets(tmp_path):
+    results = {}
+    bench.bench_crypto(results, CFG)
+    bench.bench_vault(results, CFG, tmp_path)
+    checked = [name for name in results if name.rpartition("/")[0] in bench.ALLOC_BUDGETS]
+    assert len(checked) == len(bench.ALLOC_BUDGETS) * len(CFG["entries"])
+    assert bench.over_budget(results) == []
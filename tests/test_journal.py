@@ -0,0 +1,75 @@
+from conftest import FAST_KDF, MASTER, reopen
+from vaultic import journal
+from vaultic.session import VaultSession
+from vaultic.stego import extract
+from vaultic.vault import COMPACT_BYTES
+
+
+def test_changes_go_to_the_journal(vault):
+    image = extract(vault.paths.vault_file)
+    vault.add_entry("github", "one")
+    vault.add_entry("gitlab", "two")
+    assert vault.journal_size() > 0
+    assert extract(vault.paths.vault_file) == image
+
+
+def test_replay_in_a_fresh_reader(vault):
+    vault.add_entry("github", "one")
+    vault.add_entry("github", "two")
+    vault.delete_entry("gitlab")
+    vault.add_entry("gitlab", "three")
+    assert vault.delete_entry("gitlab")
+    other = reopen(vault)
+    assert other.list_services() == ["github"]
+    assert other.get_entry("github")["password"] == "two"
+    assert [h["password"] for h in other.history("github")] == ["one"]
+
+
+def test_torn_last_frame_is_dropped(vault):
+    vault.add_entry("a", "1")
+    vault.add_entry("b", "2")
+    path = vault.paths.journal_file
+    path.write_bytes(path.read_bytes()[:-3])
+    other = reopen(vault)
+    assert other.list_services() == ["a"]
+    # the next commit appends over the torn frame
+    other.add_entry("c", "3")
+    assert reopen(vault).list_services() == ["a", "c"]
+
+
+def test_compact_folds_the_journal(vault):
+    for i in range(20):
+        vault.add_entry(f"service-{i}", str(i))
+    version = vault.version()
+    assert vault.compact()
+    assert vault.journal_size() == 0
+    assert not vault.compact()
+    other = reopen(vault)
+    assert other.version() == version
+    assert other.get_entry("service-7")["password"] == "7"
+    assert other._load().journal_seq == 0
+
+
+def test_big_batch_snapshots_instead(vault):
+    count = COMPACT_BYTES // 64
+    with vault.batch() as tx:
+        for i in range(count):
+            tx.add(f"service-{i:06d}.example.com", "x" * 40)
+    assert vault.journal_size() == 0
+    assert len(reopen(vault).list_services()) == count
+
+
+def test_lock_folds_the_journal(paths, cover):
+    session = VaultSession(paths, idle_timeout=0)
+    session.create(MASTER, cover, kdf=FAST_KDF)
+    session.unlock(MASTER)
+    session.vault().add_entry("github", "one")
+    session.lock()
+    assert session.owes_fold
+    assert session.fold()
+    assert not session.owes_fold
+    assert journal.size(paths.journal_file) == 0
+    session.unlock(MASTER)
+    vault = session.vault()
+    assert vault._load().journal_seq == 0
+    assert vault.get_entry("github")["password"] == "one"
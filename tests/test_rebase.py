@@ -0,0 +1,34 @@
+from conftest import reopen
+
+
+def test_concurrent_batches_both_land(vault):
+    other = reopen(vault)
+    with vault.batch() as tx:
+        tx.add("github", "mine")
+        # someone else commits while this batch is still open
+        other.add_entry("gitlab", "theirs")
+    fresh = reopen(vault)
+    assert fresh.list_services() == ["github", "gitlab"]
+    assert fresh.version() == 2
+
+
+def test_last_write_wins_per_service(vault):
+    vault.add_entry("github", "first")
+    other = reopen(vault)
+    other.list_services()
+    vault.add_entry("github", "second")
+    # other still holds the version before "second"
+    other.add_entry("github", "third")
+    fresh = reopen(vault)
+    assert fresh.get_entry("github")["password"] == "third"
+    assert [h["password"] for h in fresh.history("github")] == ["second", "first"]
+
+
+def test_rebase_onto_a_new_snapshot(vault):
+    other = reopen(vault)
+    other.list_services()
+    vault.add_entry("a", "1")
+    vault.compact()
+    # other's state is bound to the snapshot compact replaced
+    other.add_entry("b", "2")
+    assert reopen(vault).list_services() == ["a", "b"]
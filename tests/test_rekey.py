@@ -0,0 +1,69 @@
+import os
+from pathlib import Path
+
+import pytest
+from cryptography.exceptions import InvalidTag
+
+from conftest import FAST_KDF, MASTER
+from vaultic.kdf import KdfParams, parse_salt
+from vaultic.session import VaultSession
+from vaultic.vault import pending_salt
+
+
+@pytest.fixture
+def session(paths, cover):
+    session = VaultSession(paths, idle_timeout=0)
+    session.create(MASTER, cover, kdf=FAST_KDF)
+    session.unlock(MASTER)
+    with session.vault().batch() as tx:
+        for i in range(10):
+            tx.add(f"service-{i}", f"password-{i}")
+    return session
+
+
+def test_rekey_to_a_new_master(session, paths):
+    session.rekey(MASTER, "new master")
+    assert session.vault().get_entry("service-3")["password"] == "password-3"
+    session.lock()
+    session.fold()
+    with pytest.raises(InvalidTag):
+        session.unlock(MASTER)
+    vault = session.unlock("new master")
+    assert len(vault.list_services()) == 10
+    assert not pending_salt(paths).exists()
+
+
+def test_rekey_to_new_params(session, paths):
+    params = KdfParams(n=2**11, r=8, p=1)
+    assert session.rekey(MASTER, kdf=params) == params
+    assert parse_salt(paths.salt_file.read_bytes())[1] == params
+    session.lock()
+    vault = session.unlock(MASTER)
+    assert vault.kdf == params
+    assert vault.get_entry("service-9")["password"] == "password-9"
+
+
+def test_unlock_finishes_an_interrupted_rekey(session, paths, monkeypatch):
+    real = os.replace
+
+    # the vault is re-sealed but the process dies before salt.bin is replaced
+    def crash(src, dst):
+        if Path(src) == pending_salt(paths):
+            raise KeyboardInterrupt
+        real(src, dst)
+
+    monkeypatch.setattr(os, "replace", crash)
+    with pytest.raises(KeyboardInterrupt):
+        session.vault().rekey("new master")
+    monkeypatch.setattr(os, "replace", real)
+    assert pending_salt(paths).exists()
+    session.lock(fold=False)
+    vault = VaultSession(paths, idle_timeout=0).unlock("new master")
+    assert not pending_salt(paths).exists()
+    assert len(vault.list_services()) == 10
+
+
+def test_rekey_needs_the_current_master(session):
+    with pytest.raises(InvalidTag):
+        session.rekey("not it", "new master")
+    assert session.vault().get_entry("service-0")["password"] == "password-0"
@@ -0,0 +1,60 @@
+import pytest
+
+from conftest import reopen
+from vaultic.shards import shard_for
+
+
+def fill(vault, count):
+    with vault.batch() as tx:
+        for i in range(count):
+            tx.add(f"service-{i:03d}", f"password-{i}")
+
+
+def placed_home(vault) -> bool:
+    state = reopen(vault)._load()
+    count = len(state.shards)
+    return all(shard == shard_for(service, count) for service, shard in state.placement.items())
+
+
+def test_reshard_keeps_every_entry(vault):
+    fill(vault, 60)
+    vault.reshard(4)
+    other = reopen(vault)
+    assert len(other._load().shards) == 4
+    assert len(other.list_services()) == 60
+    assert other.get_entry("service-042")["password"] == "password-42"
+    assert placed_home(vault)
+
+
+def test_adding_shards_rebalances(vault):
+    fill(vault, 60)
+    vault.reshard(2)
+    vault.reshard(6)
+    state = reopen(vault)._load()
+    assert len(state.shards) == 6
+    assert state.pending
+    moved = vault.rebalance()
+    assert moved > 0
+    assert not reopen(vault)._load().pending
+    assert vault.rebalance() == 0
+    assert placed_home(vault)
+    assert len(reopen(vault).list_services()) == 60
+
+
+def test_writes_move_pending_entries(vault):
+    fill(vault, 60)
+    vault.reshard(2)
+    vault.reshard(4)
+    for i in range(4):
+        vault.add_entry(f"new-{i}", "x")
+        vault.compact()
+    state = reopen(vault)._load()
+    assert not state.pending
+    assert len(state.entries) == 64
+
+
+def test_shards_can_only_be_added(vault):
+    fill(vault, 10)
+    vault.reshard(4)
+    with pytest.raises(ValueError):
+        vault.reshard(2)
@@ -0,0 +1,322 @@
+from __future__ import annotations
+import asyncio
+import ctypes
+import json
+import os
+import resource
+import socket
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from cryptography.exceptions import InvalidTag
+from .remote import connect, socket_path
+from .secret import lock_memory
+from .session import SessionLocked, VaultSession
+from .vault import VaultBatch, VaultState
+
+# requests carry whole imports in one line
+MAX_REQUEST = 64 * 1024 * 1024
+IDLE_CHECK = 5.0
+# quiet seconds after the last change before the journal is folded back
+COMPACT_AFTER = 30.0
+READY_WAIT = 5.0
+
+PR_SET_DUMPABLE = 4
+
+
+# keep the key out of swap and the process out of core dumps where the
+# platform lets us, best effort. only the key is pinned: mlockall would need
+# an RLIMIT_MEMLOCK big enough for the whole heap, which defaults never allow
+def harden_process(session: VaultSession) -> None:
+    try:
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    except (ValueError, OSError):
+        pass
+    if sys.platform.startswith("linux"):
+        ctypes.CDLL(None, use_errno=True).prctl(PR_SET_DUMPABLE, 0, 0, 0, 0)
+    session.protect_keys(lock_memory)
+
+
+def _peer_uid(writer: asyncio.StreamWriter) -> Optional[int]:
+    sock = writer.get_extra_info("socket")
+    if sock is None or not hasattr(socket, "SO_PEERCRED"):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    return struct.unpack("3i", creds)[1]
+
+
+def _error(kind: str, message: str) -> Dict:
+    return {"ok": False, "kind": kind, "error": message}
+
+
+# ssh-agent style holder of an unlocked session: the derived key and the
+# decrypted index stay in this process, lookups never touch scrypt and only
+# re-read the png when its stat changes. blocking work (scrypt, png reads and
+# writes) runs on threads, one at a time, while lookups keep being served
+class Agent:
+
+    def __init__(self, session: VaultSession, path: Path):
+        self.session = session
+        self.path = path
+        # why the last journal fold after a lock failed, reported by status
+        self.fold_error: Optional[str] = None
+        self._state: Optional[VaultState] = None
+        self._stamp: Optional[Tuple[int, ...]] = None
+        self._last_change = 0.0
+        self._io = asyncio.Lock()
+        self._stopped = asyncio.Event()
+
+    # the image and its journal, a change to either means re-reading
+    def _file_stamp(self) -> Tuple[int, ...]:
+        st = os.stat(self.session.paths.vault_file)
+        try:
+            jt = os.stat(self.session.paths.journal_file)
+            jstamp = (jt.st_ino, jt.st_mtime_ns, jt.st_size)
+        except FileNotFoundError:
+            jstamp = (0, 0, 0)
+        return (st.st_ino, st.st_mtime_ns, st.st_size) + jstamp
+
+    def _drop(self) -> None:
+        self._state = None
+        self._stamp = None
+
+    def _load(self) -> VaultState:
+        stamp = self._file_stamp()
+        if self._state is None or stamp != self._stamp:
+            self._state = self.session.vault()._load()
+            self._stamp = stamp
+        return self._state
+
+    # the cached index unless the file changed, a vault that no longer opens
+    # (rekeyed elsewhere) locks the agent
+    async def _current(self) -> Tuple[VaultBatch, VaultState]:
+        vault = self.session.vault()
+        if self._state is None or self._file_stamp() != self._stamp:
+            async with self._io:
+                try:
+                    await asyncio.to_thread(self._load)
+                except (InvalidTag, ValueError):
+                    self.session.lock(fold=False)
+                    self._drop()
+                    raise SessionLocked("vault changed under the agent, unlock again")
+        return VaultBatch(vault, self._state), self._state
+
+    async def op_status(self, req: Dict) -> Dict:
+        unlocked = self.session.unlocked
+        return {
+            "unlocked": unlocked,
+            "pid": os.getpid(),
+            "entries": len(self._state.entries) if unlocked and self._state is not None else None,
+            "idle_for": self.session.idle_for() if unlocked else None,
+            "idle_timeout": self.session.idle_timeout,
+            "memory_locked": self.session.key_locked if unlocked else None,
+            "fold_error": self.fold_error,
+        }
+
+    async def op_unlock(self, req: Dict) -> bool:
+        master = req["master"]
+        async with self._io:
+            if self.session.unlocked:
+                if not await asyncio.to_thread(self.session.check, master):
+                    raise InvalidTag()
+                return True
+            await asyncio.to_thread(self.session.unlock, master)
+            self._drop()
+        await self._current()
+        return True
+
+    async def op_check(self, req: Dict) -> bool:
+        return await asyncio.to_thread(self.session.check, req["master"])
+
+    async def op_lock(self, req: Dict) -> bool:
+        async with self._io:
+            self.session.lock()
+            self._drop()
+        await self._fold()
+        return True
+
+    async def op_list(self, req: Dict) -> List[str]:
+        tx, _ = await self._current()
+        return tx.services()
+
+    async def op_get(self, req: Dict) -> Optional[Dict]:
+        tx, _ = await self._current()
+        return tx.get(req["service"])
+
+    async def op_history(self, req: Dict) -> List[Dict]:
+        tx, _ = await self._current()
+        return tx.history(req["service"])
+
+    def _apply(self, changes: List[List]) -> List[Optional[bool]]:
+        results: List[Optional[bool]] = []
+        with self.session.vault().batch() as tx:
+            for change in changes:
+                if change[0] == "add":
+                    tx.add(change[1], change[2])
+                    results.append(None)
+                elif change[0] == "rm":
+                    results.append(tx.delete(change[1]))
+                elif change[0] == "restore":
+                    results.append(tx.restore(change[1], int(change[2])))
+                else:
+                    raise ValueError(f"unknown change {change[0]!r}")
+        self._state, self._stamp = tx.state, self._file_stamp()
+        self._last_change = time.monotonic()
+        return results
+
+    async def op_apply(self, req: Dict) -> List[Optional[bool]]:
+        self.session.vault()
+        async with self._io:
+            return await asyncio.to_thread(self._apply, req["changes"])
+
+    async def op_compact(self, req: Dict) -> bool:
+        self.session.vault()
+        async with self._io:
+            done = await asyncio.to_thread(self._compact)
+        self._last_change = 0.0
+        return done
+
+    async def op_stop(self, req: Dict) -> bool:
+        self._stopped.set()
+        return True
+
+    async def dispatch(self, line: bytes) -> Dict:
+        try:
+            req = json.loads(line)
+            handler = getattr(self, f"op_{req.get('op')}", None)
+            if handler is None:
+                return _error("error", f"unknown request {req.get('op')!r}")
+            return {"ok": True, "result": await handler(req)}
+        except SessionLocked as e:
+            return _error("locked", str(e) or "vault is locked")
+        except InvalidTag:
+            return _error("wrong_master", "wrong master password")
+        except FileNotFoundError as e:
+            return _error("not_found", str(e))
+        except Exception as e:
+            return _error("error", str(e) or type(e).__name__)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        uid = _peer_uid(writer)
+        try:
+            if uid is not None and uid != os.getuid():
+                return
+            while not self._stopped.is_set():
+                line = await reader.readline()
+                if not line:
+                    break
+                reply = await self.dispatch(line)
+                writer.write(json.dumps(reply).encode("utf-8") + b"\n")
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    # the idle compaction isn't a use of the vault, it mustn't hold off expiry
+    def _compact(self, touch: bool = True) -> bool:
+        done = self.session.vault(touch=touch).compact()
+        self._drop()
+        return done
+
+    # the lock itself is instant, folding the journal back runs on a thread
+    async def _fold(self) -> None:
+        async with self._io:
+            try:
+                await asyncio.to_thread(self.session.fold)
+                self.fold_error = None
+            except Exception as e:
+                self.fold_error = str(e) or type(e).__name__
+
+    async def _expire(self) -> None:
+        while True:
+            await asyncio.sleep(IDLE_CHECK)
+            quiet = time.monotonic() - self._last_change > COMPACT_AFTER
+            if self._last_change and quiet and self.session.unlocked:
+                async with self._io:
+                    try:
+                        await asyncio.to_thread(self._compact, False)
+                        self._last_change = 0.0
+                    except Exception:
+                        pass
+            async with self._io:
+                if self.session.expire_if_idle():
+                    self._drop()
+            # also picks up a request that found the session expired
+            if self.session.owes_fold:
+                await self._fold()
+
+    async def serve(self) -> None:
+        # the socket is only ever reachable by its owner
+        old = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self.handle, path=str(self.path), limit=MAX_REQUEST)
+        finally:
+            os.umask(old)
+        expire = asyncio.create_task(self._expire())
+        try:
+            await self._current()
+        except Exception:
+            pass
+        try:
+            async with server:
+                await self._stopped.wait()
+        finally:
+            expire.cancel()
+            self.session.lock()
+            self._drop()
+            await self._fold()
+            self.path.unlink(missing_ok=True)
+
+
+def _claim_socket(path: Path) -> None:
+    client = connect(path)
+    if client is not None:
+        client.close()
+        raise RuntimeError(f"an agent is already running on {path}")
+    # left behind by an agent that died
+    path.unlink(missing_ok=True)
+    path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+
+
+def _detach() -> bool:
+    if os.fork() > 0:
+        return False
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    os.close(devnull)
+    return True
+
+
+def _wait_ready(path: Path) -> bool:
+    deadline = time.monotonic() + READY_WAIT
+    while time.monotonic() < deadline:
+        client = connect(path)
+        if client is not None:
+            client.close()
+            return True
+        time.sleep(0.05)
+    return False
+
+
+# unlock in the foreground (so a wrong master fails right here), then fork
+# and serve from the child unless foreground is set
+def run(session: VaultSession, master: str, path: Optional[Path] = None, foreground: bool = False) -> int:
+    path = path or socket_path(session.paths)
+    _claim_socket(path)
+    session.unlock(master)
+    if not foreground and not _detach():
+        if not _wait_ready(path):
+            print(f"vaultic agent did not come up on {path}", file=sys.stderr)
+            return 1
+        print(f"vaultic agent listening on {path}", file=sys.stderr)
+        return 0
+
+    agent = Agent(session, path)
+    harden_process(session)
+    asyncio.run(agent.serve())
+    return 0
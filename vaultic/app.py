@@ -1,18 +1,93 @@
+import sys
+import threading
+from typing import Optional
 from textual.app import App
 from textual.widgets import Header, Footer
-from .screens import HomeScreen
+from .screens import HomeScreen, TraceScreen
+from .search import ServiceIndex
+from .trace import StartupProfile, tracer
 
+# the first frame paints before anything heavy loads: the session (and with
+# it cryptography) is created by the home screen's first background task,
+# pillow and requests by the preview and the meme download
 class Vaultic(App):
     CSS_PATH = "styles.tcss"
+    BINDINGS = [("ctrl+l", "lock", "lock vault"), ("ctrl+t", "toggle_trace", "timings")]
+
+    def __init__(self, profile: Optional[StartupProfile] = None) -> None:
+        super().__init__()
+        self.profile = profile
+        self._session = None
+        self._covers = None
+        self._loading = threading.Lock()
+        # service names every screen searches and keeps current, built on a
+        # worker by the first GetScreen and dropped on lock
+        self.services: Optional[ServiceIndex] = None
+
+    @property
+    def session(self):
+        with self._loading:
+            if self._session is None:
+                from .session import VaultSession
+                self._session = VaultSession(use_agent=True)
+            return self._session
+
+    @property
+    def covers(self):
+        if self._covers is None:
+            from .meme import CoverCache
+            self._covers = CoverCache(self.session.paths.dir / "covers")
+        return self._covers
+
     def compose(self):
         yield Header(show_clock=True)
         yield Footer()
-        
+
     def on_mount(self) -> None:
+        if self.profile:
+            self.profile.mark("app mounted")
         self.push_screen(HomeScreen())
+        self.set_interval(5, self.check_session_idle)
+
+    def check_session_idle(self) -> None:
+        if self._session is not None and self._session.expire_if_idle():
+            self.lock_screens("vault locked after inactivity")
+
+    def action_lock(self) -> None:
+        self.session.lock()
+        self.lock_screens("vault locked")
+
+    # the debug panel turns span recording on for the rest of the run
+    def action_toggle_trace(self) -> None:
+        if isinstance(self.screen, TraceScreen):
+            self.pop_screen()
+            return
+        if not tracer.enabled:
+            tracer.enable()
+        self.push_screen(TraceScreen())
+
+    # drop back to the home screen whenever the session goes away, it folds
+    # the journal back on a worker
+    def lock_screens(self, message: str) -> None:
+        while len(self.screen_stack) > 2:
+            self.pop_screen()
+        home = self.screen
+        if isinstance(home, HomeScreen):
+            home.locked(message)
+            home.start_task("fold", self.session.fold, label=None)
 
-def main():
-    Vaultic().run()
+# with a profile the app quits once the home screen is fully loaded
+def main(profile: Optional[StartupProfile] = None):
+    app = Vaultic(profile)
+    app.run()
+    # folds any journal back into the image before the key goes away, the
+    # loop is gone so this can block
+    if app._session is not None:
+        app._session.lock()
+        try:
+            app._session.fold()
+        except Exception as e:
+            print(f"vaultic: journal not folded back into the vault: {e}", file=sys.stderr)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,455 @@
+"""vaultic from scripts, without the tui
+
+    vaultic                       start the tui
+    vaultic --profile-startup     start it, quit once loaded and print how long each stage took
+    vaultic list
+    vaultic get SERVICE [--clip]
+    vaultic add SERVICE           entry password from the tty, or the next stdin line
+    vaultic add SERVICE --generate [--length N] [--classes ...]
+    vaultic rm SERVICE
+    vaultic history SERVICE [--reveal] [--restore N]
+    vaultic import FILE [--format csv|bitwarden|keepass] [--generate]
+    vaultic gen [-n COUNT] [--length N] [--classes lower,upper,digits,symbols] [--words N]
+    vaultic compact               fold the journal of recent changes into the image
+    vaultic shard [COUNT [--cover IMAGE ...]] [--rebalance]
+    vaultic rekey [--change-master] [--target SECONDS | --log-n N] [--r R] [--p P]
+    vaultic fleet verify|migrate|rekey DIR_OR_MANIFEST [--jobs N] [--state FILE]
+    vaultic agent [--foreground] [--timeout SECONDS] | --status | --lock | --stop
+
+the master password comes from VAULTIC_MASTER, else the first line of stdin
+when it is not a tty, else a prompt on the tty. while an unlocked agent is
+running every command goes through it and no master password is asked for.
+"""
+from __future__ import annotations
+import argparse
+import os
+import sys
+from pathlib import Path
+from typing import List, Optional
+
+# every command imports what it needs itself, `vaultic get` must not pay for
+# textual, pillow, numpy or requests
+
+IMPORT_FORMATS = ("csv", "bitwarden", "keepass")
+
+
+class CliError(Exception):
+    pass
+
+
+def _stdin_line() -> Optional[str]:
+    line = sys.stdin.readline()
+    if not line:
+        return None
+    return line.rstrip("\r\n")
+
+
+def read_secret(prompt: str, env: Optional[str] = None, confirm: bool = False) -> str:
+    if env and os.environ.get(env):
+        return os.environ[env]
+    if not sys.stdin.isatty():
+        value = _stdin_line()
+        if value is None:
+            raise CliError(f"expected {prompt.rstrip(': ')} on stdin")
+        return value
+    import getpass
+    value = getpass.getpass(prompt)
+    if confirm and getpass.getpass("again: ") != value:
+        raise CliError("passwords don't match")
+    return value
+
+
+def _session(use_agent: bool = True):
+    from .session import VaultSession
+    return VaultSession(idle_timeout=0, use_agent=use_agent)
+
+
+def _unlock(master: Optional[str] = None, session=None):
+    from cryptography.exceptions import InvalidTag
+    session = session or _session()
+    if not session.paths.vault_file.exists():
+        raise CliError(f"no vault at {session.paths.vault_file}, create one from the tui first")
+    if master is None:
+        if session.attach_agent():
+            return session.vault()
+        master = read_secret("master password: ", env="VAULTIC_MASTER")
+    try:
+        return session.unlock(master)
+    except InvalidTag:
+        raise CliError("wrong master password") from None
+    except ValueError as e:
+        raise CliError(str(e)) from None
+
+
+def cmd_list(args: argparse.Namespace) -> int:
+    vault = _unlock()
+    for service in vault.list_services():
+        print(service)
+    return 0
+
+
+def cmd_get(args: argparse.Namespace) -> int:
+    vault = _unlock()
+    entry = vault.get_entry(args.service)
+    if entry is None:
+        raise CliError(f"no entry for {args.service}")
+    if args.clip:
+        import pyperclip
+        pyperclip.copy(entry["password"])
+        print(f"copied {args.service.strip().lower()}", file=sys.stderr)
+    else:
+        print(entry["password"])
+    return 0
+
+
+def _policy(args: argparse.Namespace):
+    from .passgen import Policy
+    classes = tuple(c.strip() for c in args.classes.split(",") if c.strip())
+    try:
+        return Policy(
+            length=args.length,
+            classes=classes,
+            require=not args.any,
+            exclude_lookalike=args.no_lookalike,
+            exclude=args.exclude,
+        )
+    except ValueError as e:
+        raise CliError(str(e)) from None
+
+
+def cmd_gen(args: argparse.Namespace) -> int:
+    from . import passgen
+    if args.count < 1:
+        raise CliError("count must be at least 1")
+    try:
+        if args.words:
+            results = passgen.passphrases(args.words, args.count, args.sep)
+        else:
+            results = passgen.passwords(_policy(args), args.count)
+    except ValueError as e:
+        raise CliError(str(e)) from None
+    for r in results:
+        print(f"{r.password}\t{r.bits:.1f}" if args.entropy else r.password)
+    return 0
+
+
+def cmd_add(args: argparse.Namespace) -> int:
+    # a bad policy fails before the master password is asked for
+    policy = _policy(args) if args.generate else None
+    vault = _unlock()
+    if policy is not None:
+        from .passgen import passwords
+        generated = passwords(policy)[0]
+        password = generated.password
+    else:
+        password = read_secret(f"password for {args.service}: ", confirm=True)
+    if not password:
+        raise CliError("empty password")
+    vault.add_entry(args.service, password)
+    if policy is not None:
+        print(f"stored a generated {len(password)} character password ({generated.bits:.0f} bits)", file=sys.stderr)
+    return 0
+
+
+def cmd_rm(args: argparse.Namespace) -> int:
+    vault = _unlock()
+    if not vault.delete_entry(args.service):
+        raise CliError(f"no entry for {args.service}")
+    return 0
+
+
+def cmd_history(args: argparse.Namespace) -> int:
+    import time
+    vault = _unlock()
+    if args.restore is not None:
+        if not vault.restore(args.service, args.restore - 1):
+            raise CliError(f"{args.service} has no version {args.restore}")
+        print(f"restored version {args.restore} of {args.service.strip().lower()}", file=sys.stderr)
+        return 0
+    versions = vault.history(args.service)
+    if not versions and vault.get_entry(args.service) is None:
+        raise CliError(f"no entry for {args.service}")
+    for n, version in enumerate(versions, 1):
+        replaced = time.strftime("%Y-%m-%d %H:%M", time.localtime(version["replaced"]))
+        print(f"{n:3d}  replaced {replaced}" + (f"  {version['password']}" if args.reveal else ""))
+    return 0
+
+
+def cmd_import(args: argparse.Namespace) -> int:
+    from .importer import import_file
+    policy = _policy(args) if args.generate else None
+    vault = _unlock()
+    try:
+        result = import_file(vault, args.file, args.format, generate=policy)
+    except ValueError as e:
+        raise CliError(f"nothing imported: {e}") from None
+    generated = f" ({result.generated} generated)" if policy else ""
+    print(f"imported {result.imported}{generated}, skipped {result.skipped}", file=sys.stderr)
+    return 0
+
+
+def cmd_compact(args: argparse.Namespace) -> int:
+    vault = _unlock()
+    if not vault.compact():
+        print("nothing to compact", file=sys.stderr)
+    return 0
+
+
+def cmd_shard(args: argparse.Namespace) -> int:
+    # rewrites images the agent may have cached, always done locally
+    vault = _unlock(session=_session(use_agent=False))
+    try:
+        if args.count:
+            vault.reshard(args.count, args.cover or ())
+        if args.rebalance:
+            print(f"moved {vault.rebalance()} entries", file=sys.stderr)
+    except ValueError as e:
+        raise CliError(str(e)) from None
+    layout, pending = vault.shard_layout()
+    if not layout:
+        print(f"single image, {len(vault.list_services())} entries")
+        return 0
+    for shard, (name, entries) in enumerate(layout):
+        print(f"{shard:3d}  {entries:7d}  {name}")
+    if pending:
+        print(f"{pending} shards still to rebalance", file=sys.stderr)
+    return 0
+
+
+# --target calibrates, --log-n takes n as given, --r and --p go with either.
+# None keeps each vault's own params
+def _kdf_from_args(args: argparse.Namespace):
+    from .kdf import DEFAULT_P, DEFAULT_R, calibrate, explicit
+    r = DEFAULT_R if args.r is None else args.r
+    p = DEFAULT_P if args.p is None else args.p
+    if args.log_n is not None:
+        try:
+            kdf = explicit(args.log_n, r, p)
+        except ValueError as e:
+            raise CliError(str(e))
+    elif args.target:
+        kdf = calibrate(target=args.target, r=r, p=p)
+    elif args.r is not None or args.p is not None:
+        raise CliError("--r and --p need --target or --log-n")
+    else:
+        return None
+    if kdf.weak:
+        print(f"warning: {kdf} is cheaper to brute force than the old n=2^14 r=8 p=1 default", file=sys.stderr)
+    return kdf
+
+
+def cmd_rekey(args: argparse.Namespace) -> int:
+    session = _session()
+    master = read_secret("master password: ", env="VAULTIC_MASTER")
+    _unlock(master, session)
+    new_master = None
+    if args.change_master:
+        new_master = read_secret("new master password: ", confirm=True)
+        if not new_master:
+            raise CliError("empty password")
+    params = session.rekey(master, new_master, _kdf_from_args(args))
+    print(f"rekeyed with {params}", file=sys.stderr)
+    return 0
+
+
+def cmd_fleet(args: argparse.Namespace) -> int:
+    import json
+    from . import fleet
+    found = fleet.discover(args.source)
+    if not found:
+        raise CliError(f"no vaults found in {args.source}")
+    master = read_secret("master password: ", env="VAULTIC_MASTER")
+    new_master = None
+    kdf = None
+    if args.action == "rekey":
+        if args.change_master:
+            new_master = read_secret("new master password: ", env="VAULTIC_NEW_MASTER", confirm=True)
+            if not new_master:
+                raise CliError("empty password")
+        params = _kdf_from_args(args)
+        kdf = params.as_tuple() if params is not None else None
+    jobs = [
+        fleet.FleetJob(name, str(vault_file), str(salt_file), args.action, master, new_master, kdf)
+        for name, vault_file, salt_file in found
+    ]
+
+    def emit(result):
+        print(json.dumps(result), flush=True)
+
+    state = Path(args.state) if args.state else None
+    summary = fleet.run(jobs, workers=args.jobs, state_file=state, emit=emit)
+    print(
+        f"{args.action}: {summary['ok']} ok, {summary['failed']} failed, {summary['skipped']} already done "
+        f"of {summary['total']} in {summary['seconds']}s on {summary['workers']} workers",
+        file=sys.stderr,
+    )
+    for name in summary["failures"]:
+        print(f"  failed: {name}", file=sys.stderr)
+    return 1 if summary["failed"] else 0
+
+
+def cmd_agent(args: argparse.Namespace) -> int:
+    from .remote import connect
+    if args.status or args.lock or args.stop:
+        client = connect()
+        if client is None:
+            raise CliError("no agent running")
+        if args.status:
+            for key, value in client.status().items():
+                print(f"{key}: {value}")
+        else:
+            client.request("lock" if args.lock else "stop")
+        client.close()
+        return 0
+
+    from .agent import run
+    from .session import VaultSession
+    from cryptography.exceptions import InvalidTag
+    session = VaultSession(idle_timeout=args.timeout)
+    if not session.paths.vault_file.exists():
+        raise CliError(f"no vault at {session.paths.vault_file}, create one from the tui first")
+    master = read_secret("master password: ", env="VAULTIC_MASTER")
+    try:
+        return run(session, master, foreground=args.foreground)
+    except InvalidTag:
+        raise CliError("wrong master password") from None
+    except (ValueError, RuntimeError) as e:
+        raise CliError(str(e)) from None
+
+
+def _policy_options(p: argparse.ArgumentParser) -> None:
+    p.add_argument("--length", type=int, default=16, help="characters per password (default 16)")
+    p.add_argument("--classes", default="lower,upper,digits,symbols", help="comma separated classes to draw from")
+    p.add_argument("--any", action="store_true", help="don't require one character of every class")
+    p.add_argument("--no-lookalike", action="store_true", help="leave out I l 1 | O 0 o")
+    p.add_argument("--exclude", default="", help="characters to leave out")
+
+
+def _kdf_args(p: argparse.ArgumentParser, prefix: str) -> None:
+    from_n = p.add_mutually_exclusive_group()
+    from_n.add_argument("--target", type=float, help=f"{prefix}calibrate scrypt for this many seconds per unlock")
+    from_n.add_argument("--log-n", type=int, help=f"{prefix}use scrypt n=2^N as given instead of calibrating")
+    p.add_argument("--r", type=int, help=f"{prefix}scrypt block size with --target or --log-n (default 8)")
+    p.add_argument("--p", type=int, help=f"{prefix}scrypt parallelism with --target or --log-n (default 1)")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="vaultic", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profile-startup", action="store_true", help="time the tui coming up (imports, mount, first paint, preview) and quit")
+    sub = parser.add_subparsers(dest="command")
+
+    p = sub.add_parser("list", help="print every service name")
+    p.set_defaults(fn=cmd_list)
+
+    p = sub.add_parser("get", help="print or copy a password")
+    p.add_argument("service")
+    p.add_argument("--clip", action="store_true", help="copy to the clipboard instead of printing")
+    p.set_defaults(fn=cmd_get)
+
+    p = sub.add_parser("add", help="add or replace a password")
+    p.add_argument("service")
+    p.add_argument("--generate", action="store_true", help="store a generated password instead of asking for one")
+    _policy_options(p)
+    p.set_defaults(fn=cmd_add)
+
+    p = sub.add_parser("rm", help="delete a password")
+    p.add_argument("service")
+    p.set_defaults(fn=cmd_rm)
+
+    p = sub.add_parser("history", help="list earlier passwords of an entry, newest first, or restore one")
+    p.add_argument("service")
+    p.add_argument("--reveal", action="store_true", help="print the passwords too")
+    p.add_argument("--restore", type=int, metavar="N", help="make version N current again")
+    p.set_defaults(fn=cmd_history)
+
+    p = sub.add_parser("import", help="import a csv, bitwarden json or keepass xml export")
+    p.add_argument("file")
+    p.add_argument("--format", choices=IMPORT_FORMATS, help="default: from the file extension")
+    p.add_argument("--generate", action="store_true", help="generate passwords for rows that have none")
+    _policy_options(p)
+    p.set_defaults(fn=cmd_import)
+
+    p = sub.add_parser("gen", help="print generated passwords or passphrases, no vault needed")
+    p.add_argument("-n", "--count", type=int, default=1, help="how many (default 1)")
+    _policy_options(p)
+    p.add_argument("--words", type=int, help="passphrase of this many words from the bundled list instead")
+    p.add_argument("--sep", default="-", help="passphrase word separator (default -)")
+    p.add_argument("--entropy", action="store_true", help="print each result's entropy in bits after a tab")
+    p.set_defaults(fn=cmd_gen)
+
+    p = sub.add_parser("compact", help="fold recent changes from vault.journal into vault.png")
+    p.set_defaults(fn=cmd_compact)
+
+    p = sub.add_parser("shard", help="spread the vault over several images, or show how it is spread")
+    p.add_argument("count", type=int, nargs="?", help="split into, or grow to, this many shard images")
+    p.add_argument("--cover", action="append", help="image for new shards, repeat for more (default: vault.png's)")
+    p.add_argument("--rebalance", action="store_true", help="move every entry to its home shard now")
+    p.set_defaults(fn=cmd_shard)
+
+    p = sub.add_parser("rekey", help="re-seal the vault under new kdf params or a new master")
+    p.add_argument("--change-master", action="store_true", help="prompt for a new master password")
+    _kdf_args(p, "")
+    p.set_defaults(fn=cmd_rekey)
+
+    p = sub.add_parser("fleet", help="verify, migrate or rekey many vaults in parallel")
+    p.add_argument("action", choices=("verify", "migrate", "rekey"))
+    p.add_argument("source", help="directory of <name>/vault.png + salt.bin, or a manifest of vault paths")
+    p.add_argument("--jobs", type=int, help="worker processes (default: cpu count)")
+    p.add_argument("--state", help="append results here and skip vaults it already lists as done")
+    p.add_argument("--change-master", action="store_true", help="rekey: new master from VAULTIC_NEW_MASTER or a prompt")
+    _kdf_args(p, "rekey: ")
+    p.set_defaults(fn=cmd_fleet)
+
+    p = sub.add_parser("agent", help="unlock once and serve lookups from a background process")
+    p.add_argument("--foreground", action="store_true", help="don't detach")
+    p.add_argument("--timeout", type=float, help="lock after this many idle seconds, 0 never (default VAULTIC_IDLE_TIMEOUT or 300)")
+    control = p.add_mutually_exclusive_group()
+    control.add_argument("--status", action="store_true", help="show the running agent")
+    control.add_argument("--lock", action="store_true", help="make the running agent forget the key")
+    control.add_argument("--stop", action="store_true", help="stop the running agent")
+    p.set_defaults(fn=cmd_agent)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.profile_startup and args.command is not None:
+        parser.error("--profile-startup only applies to the tui")
+    if args.command is None:
+        profile = None
+        if args.profile_startup:
+            from .trace import StartupProfile
+            profile = StartupProfile()
+            # timed on its own, it is most of what is left to import
+            import textual.app
+            profile.mark("import textual")
+        from .app import main as tui
+        if profile:
+            profile.mark("import vaultic.app")
+        tui(profile)
+        if profile:
+            print(profile.report(), file=sys.stderr)
+        return 0
+    try:
+        return args.fn(args)
+    except (CliError, FileNotFoundError) as e:
+        print(f"vaultic: {e}", file=sys.stderr)
+        return 1
+    except Exception as e:
+        # only reachable once a command imported these already
+        from cryptography.exceptions import InvalidTag
+        from .remote import AgentError
+        from .session import SessionLocked
+        if isinstance(e, InvalidTag):
+            message = "wrong master password"
+        elif isinstance(e, (SessionLocked, AgentError)):
+            message = str(e)
+        else:
+            raise
+        print(f"vaultic: {message}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+from __future__ import annotations
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+# bulk verify / migrate / rekey over many vault images. scrypt keeps a core
+# busy and barely releases the gil, so every vault is handled in its own
+# worker process and results stream back as they finish
+
+ACTIONS = ("verify", "migrate", "rekey")
+
+
+@dataclass
+class FleetJob:
+    name: str
+    vault_file: str
+    salt_file: str
+    action: str
+    master: str
+    new_master: Optional[str] = None
+    # (n, r, p) calibrated once by the parent, None keeps each vault's own
+    kdf: Optional[Tuple[int, int, int]] = None
+
+
+# a directory holds one vault per subdirectory (vault.png + salt.bin, the
+# ~/.vaultic layout), a manifest lists one vault per line with an optional
+# salt path after it, relative to the manifest, # starts a comment
+def discover(source: str | Path) -> List[Tuple[str, Path, Path]]:
+    source = Path(source)
+    found = []
+    if source.is_dir():
+        for vault_file in sorted(source.glob("*/vault.png")):
+            found.append((vault_file.parent.name, vault_file, vault_file.with_name("salt.bin")))
+        return found
+
+    for line in source.read_text(encoding="utf-8").splitlines():
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        parts = line.split()
+        vault_file = (source.parent / parts[0]).resolve()
+        salt_file = (source.parent / parts[1]).resolve() if len(parts) > 1 else vault_file.with_name("salt.bin")
+        found.append((parts[0], vault_file, salt_file))
+    return found
+
+
+def _unlock(session, job: FleetJob):
+    from cryptography.exceptions import InvalidTag
+    try:
+        return session.unlock(job.master), False
+    except InvalidTag:
+        if job.action != "rekey" or not job.new_master:
+            raise
+    # an earlier, interrupted run already moved this vault to the new master
+    return session.unlock(job.new_master), True
+
+
+def run_job(job: FleetJob) -> Dict:
+    from cryptography.exceptions import InvalidTag
+    from .kdf import KdfParams, parse_salt, write_salt
+    from .session import VaultSession
+    from .vault import VaultPaths
+
+    start = time.perf_counter()
+    result: Dict = {"name": job.name, "vault": job.vault_file, "action": job.action, "ok": False}
+    vault_file, salt_file = Path(job.vault_file), Path(job.salt_file)
+    try:
+        if not vault_file.exists():
+            raise FileNotFoundError(f"{vault_file} not found")
+        if not salt_file.exists():
+            # unlocking would quietly create a fresh, useless salt
+            raise FileNotFoundError(f"{salt_file} not found")
+        paths = VaultPaths(dir=vault_file.parent, vault_file=vault_file, salt_file=salt_file)
+        session = VaultSession(paths, idle_timeout=0)
+        vault, done_before = _unlock(session, job)
+
+        if job.action == "verify":
+            result["entries"] = len(vault.list_services())
+            result["kdf"] = str(vault.kdf)
+            result["journal_bytes"] = vault.journal_size()
+
+        elif job.action == "migrate":
+            # reading only converts old payloads in memory, this rewrites the image
+            # in the current layout and puts a kdf header on bare salts
+            raw = salt_file.read_bytes()
+            salt, kdf = parse_salt(raw)
+            if raw == salt:
+                write_salt(salt_file, salt, kdf)
+                result["salt_upgraded"] = True
+            vault.compact(force=True)
+            result["entries"] = len(vault.list_services())
+
+        elif job.action == "rekey":
+            if done_before:
+                result["skipped"] = "already rekeyed"
+            else:
+                kdf = KdfParams(*job.kdf) if job.kdf else None
+                result["kdf"] = str(session.rekey(job.master, job.new_master, kdf))
+        result["ok"] = True
+    except InvalidTag:
+        result["error"] = "wrong master password"
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+# a manifest can list several vaults of one directory, all falling back to
+# its salt.bin. a rekey writes a new salt (and salt.bin.next) that the others
+# were never sealed under, so those jobs are refused, run or not in parallel.
+# maps each such job's vault to the other vaults sharing its salt
+def shared_salts(jobs: List[FleetJob]) -> Dict[str, List[str]]:
+    users: Dict[str, List[str]] = {}
+    for job in jobs:
+        users.setdefault(os.path.realpath(job.salt_file), []).append(job.vault_file)
+    shared = {}
+    for vaults in users.values():
+        if len(vaults) > 1:
+            for vault in vaults:
+                shared[vault] = [other for other in vaults if other != vault]
+    return shared
+
+
+def _refused(job: FleetJob, others: List[str]) -> Dict:
+    return {
+        "name": job.name,
+        "vault": job.vault_file,
+        "action": job.action,
+        "ok": False,
+        "error": f"{job.salt_file} is also the salt of {', '.join(others)}, give each vault its own salt before rekeying",
+        "seconds": 0.0,
+    }
+
+
+# names that already succeeded for this action in an earlier run's state file
+def completed(state_file: Optional[Path], action: str) -> set:
+    done = set()
+    if state_file is None or not state_file.exists():
+        return done
+    for line in state_file.read_text(encoding="utf-8").splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # a line cut short when the last run was killed
+            continue
+        if record.get("action") == action and record.get("ok"):
+            done.add(record["vault"])
+    return done
+
+
+def run(
+    jobs: List[FleetJob],
+    workers: Optional[int] = None,
+    state_file: Optional[Path] = None,
+    emit: Callable[[Dict], None] = lambda r: None,
+) -> Dict:
+    summary = {"total": len(jobs), "ok": 0, "failed": 0, "skipped": 0, "failures": []}
+    skip = completed(state_file, jobs[0].action) if jobs else set()
+    pending = [job for job in jobs if job.vault_file not in skip]
+    summary["skipped"] = len(jobs) - len(pending)
+
+    shared = shared_salts(jobs) if jobs and jobs[0].action == "rekey" else {}
+    refused = [_refused(job, shared[job.vault_file]) for job in pending if job.vault_file in shared]
+    pending = [job for job in pending if job.vault_file not in shared]
+
+    start = time.perf_counter()
+    state = open(state_file, "a", encoding="utf-8") if state_file else None
+    workers = max(1, min(workers or os.cpu_count() or 1, len(pending) or 1))
+    executor = ProcessPoolExecutor(max_workers=workers)
+
+    def record(result: Dict) -> None:
+        if result["ok"]:
+            summary["ok"] += 1
+        else:
+            summary["failed"] += 1
+            summary["failures"].append(result["name"])
+        if state is not None:
+            state.write(json.dumps(result) + "\n")
+            state.flush()
+        emit(result)
+
+    try:
+        for result in refused:
+            record(result)
+        futures = [executor.submit(run_job, job) for job in pending]
+        for future in as_completed(futures):
+            record(future.result())
+    except KeyboardInterrupt:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        if state is not None:
+            state.close()
+    summary["workers"] = workers
+    summary["seconds"] = round(time.perf_counter() - start, 3)
+    return summary
@@ -0,0 +1,58 @@
+from __future__ import annotations
+import heapq
+from typing import Callable, Dict, List, Optional
+
+# earlier passwords of an entry live in one more sealed record next to its
+# current one, newest first, so deflate compresses the versions together and
+# nothing but history() ever opens it: reveals and listings stay as they
+# were. the index only carries a summary (record id, how many, the oldest
+# one) which is enough to find the history the vault wide limit drops first.
+# sealing lives in vault.py, this module only edits version lists
+
+# versions kept per entry
+KEEP_PER_ENTRY = 10
+# versions kept over the whole vault, the oldest go first
+KEEP_TOTAL = 2000
+
+Version = Dict  # {"password", "set": when it became current, "replaced": when it stopped}
+
+
+# the superseded password goes in front. it and the password replacing it
+# are taken out of the older versions, a password is never kept twice and
+# never shows up as history of itself
+def push(versions: List[Version], password: str, set_at: int, replaced_at: int, current: str, keep: int = KEEP_PER_ENTRY) -> List[Version]:
+    older = [v for v in versions if v["password"] not in (password, current)]
+    return [{"password": password, "set": set_at, "replaced": replaced_at}] + older[:max(0, keep - 1)]
+
+
+def summary(record_id: str, versions: List[Version]) -> Optional[Dict]:
+    if not versions:
+        return None
+    return {"id": record_id, "n": len(versions), "oldest": versions[-1]["replaced"]}
+
+
+def total(entries: Dict[str, Dict]) -> int:
+    return sum(meta["history"]["n"] for meta in entries.values() if "history" in meta)
+
+
+# the vault wide limit: drops the oldest versions across entries until at
+# most keep are left. only entries holding the oldest ones are opened (load
+# returns an entry's versions), returns the new version lists of those
+def trim(entries: Dict[str, Dict], load: Callable[[str], List[Version]], keep: int = KEEP_TOTAL) -> Dict[str, List[Version]]:
+    excess = total(entries) - keep
+    if excess <= 0:
+        return {}
+    heap = [(meta["history"]["oldest"], service) for service, meta in entries.items() if "history" in meta]
+    heapq.heapify(heap)
+    trimmed: Dict[str, List[Version]] = {}
+    while excess > 0 and heap:
+        _, service = heapq.heappop(heap)
+        versions = trimmed.get(service)
+        if versions is None:
+            versions = list(load(service))
+        versions.pop()
+        trimmed[service] = versions
+        excess -= 1
+        if versions:
+            heapq.heappush(heap, (versions[-1]["replaced"], service))
+    return trimmed
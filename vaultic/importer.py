@@ -0,0 +1,191 @@
+from __future__ import annotations
+import codecs
+import csv
+import io
+import json
+import os
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterator, Optional, Tuple
+from urllib.parse import urlparse
+from .passgen import Policy, stream
+from .vault import Vault
+
+READ_BLOCK = 64 * 1024
+PROGRESS_EVERY = 100
+
+# (rows done, bytes read, total bytes)
+Progress = Callable[[int, int, int], None]
+
+@dataclass
+class ImportRow:
+    service: str
+    password: str
+    username: str = ""
+
+@dataclass
+class ImportResult:
+    imported: int = 0
+    skipped: int = 0
+    generated: int = 0
+
+def _host(url: str) -> str:
+    if not url:
+        return ""
+    host = urlparse(url if "://" in url else f"https://{url}").hostname or ""
+    return host[4:] if host.startswith("www.") else host
+
+def _row(name: str, url: str, username: str, password: str) -> Optional[ImportRow]:
+    service = (name or "").strip() or _host((url or "").strip())
+    if not service:
+        return None
+    return ImportRow(service=service, password=password, username=(username or "").strip())
+
+# chrome, firefox, bitwarden, 1password and generic name/url/username/password csv exports
+def read_csv(f: BinaryIO) -> Iterator[Optional[ImportRow]]:
+    text = io.TextIOWrapper(f, encoding="utf-8-sig", newline="")
+    reader = csv.DictReader(text)
+    for raw in reader:
+        row = {(k or "").strip().lower(): (v or "") for k, v in raw.items()}
+        yield _row(
+            row.get("name") or row.get("title") or "",
+            row.get("url") or row.get("login_uri") or row.get("website") or "",
+            row.get("username") or row.get("login_username") or row.get("email") or "",
+            row.get("password") or row.get("login_password") or "",
+        )
+
+def _bitwarden_item(item: dict) -> Optional[ImportRow]:
+    login = item.get("login") or {}
+    uris = login.get("uris") or []
+    url = (uris[0] or {}).get("uri", "") if uris else ""
+    return _row(item.get("name") or "", url or "", login.get("username") or "", login.get("password") or "")
+
+# decodes the "items" array one object at a time, so only the current item
+# and a read block are ever held in memory
+def read_bitwarden(f: BinaryIO) -> Iterator[Optional[ImportRow]]:
+    decoder = json.JSONDecoder()
+    # a character split across two blocks is carried over, invalid utf-8
+    # raises rather than turning part of a password into U+FFFD
+    text = codecs.getincrementaldecoder("utf-8-sig")()
+    start = re.compile(r'"items"\s*:\s*\[')
+    buf = ""
+    eof = False
+
+    def fill() -> bool:
+        nonlocal buf, eof
+        if eof:
+            return False
+        block = f.read(READ_BLOCK)
+        try:
+            buf += text.decode(block, final=not block)
+        except UnicodeDecodeError:
+            raise ValueError("bitwarden export is not valid utf-8") from None
+        if not block:
+            eof = True
+            return False
+        return True
+
+    while True:
+        match = start.search(buf)
+        if match:
+            buf = buf[match.end():]
+            break
+        buf = buf[-32:]
+        if not fill():
+            raise ValueError("no items found in bitwarden export")
+
+    while True:
+        buf = buf.lstrip(" \t\r\n,")
+        if buf.startswith("]"):
+            return
+        if not buf:
+            if not fill():
+                raise ValueError("bitwarden export ended unexpectedly")
+            continue
+        try:
+            item, end = decoder.raw_decode(buf)
+        except json.JSONDecodeError:
+            if eof or not fill():
+                raise ValueError("bitwarden export is not valid json")
+            continue
+        buf = buf[end:]
+        yield _bitwarden_item(item) if isinstance(item, dict) else None
+
+# keepass 2.x xml export, entries under <History> are old versions and skipped
+def read_keepass(f: BinaryIO) -> Iterator[Optional[ImportRow]]:
+    from xml.etree.ElementTree import iterparse
+
+    history = 0
+    for event, elem in iterparse(f, events=("start", "end")):
+        if elem.tag == "History":
+            history += 1 if event == "start" else -1
+            if event == "end":
+                elem.clear()
+            continue
+        if event != "end" or elem.tag != "Entry":
+            continue
+        if history == 0:
+            fields = {}
+            for string in elem.findall("String"):
+                fields[string.findtext("Key", "")] = string.findtext("Value", "") or ""
+            yield _row(fields.get("Title", ""), fields.get("URL", ""), fields.get("UserName", ""), fields.get("Password", ""))
+        elem.clear()
+
+FORMATS = {
+    "csv": read_csv,
+    "bitwarden": read_bitwarden,
+    "keepass": read_keepass,
+}
+
+def detect_format(path: str | Path) -> str:
+    suffix = Path(path).suffix.lower()
+    if suffix == ".csv":
+        return "csv"
+    if suffix == ".json":
+        return "bitwarden"
+    if suffix == ".xml":
+        return "keepass"
+    raise ValueError(f"can't tell the export format of {path}, use csv, json or xml")
+
+def read_rows(path: str | Path, fmt: Optional[str] = None) -> Iterator[Tuple[Optional[ImportRow], int, int]]:
+    reader = FORMATS[fmt or detect_format(path)]
+    total = os.path.getsize(path)
+    with open(path, "rb") as f:
+        for row in reader(f):
+            yield row, f.tell(), total
+
+# streams an export into the vault inside a single batch, so the vault is
+# read once and written once however many rows there are. rows without a
+# password are skipped, or get one from the generate policy
+def import_file(
+    vault: Vault,
+    path: str | Path,
+    fmt: Optional[str] = None,
+    progress: Optional[Progress] = None,
+    generate: Optional[Policy] = None,
+) -> ImportResult:
+    result = ImportResult()
+    seen = set()
+    total = 0
+    fresh = stream(generate) if generate is not None else None
+    with vault.batch() as tx:
+        for row, read, total in read_rows(path, fmt):
+            if row is not None and not row.password and fresh is not None:
+                row.password = next(fresh).password
+                result.generated += 1
+            if row is None or not row.password:
+                result.skipped += 1
+            else:
+                service = row.service.strip().lower()
+                if service in seen and row.username:
+                    service = f"{service} ({row.username.lower()})"
+                seen.add(service)
+                tx.add(service, row.password)
+                result.imported += 1
+            done = result.imported + result.skipped
+            if progress and done % PROGRESS_EVERY == 0:
+                progress(done, read, total)
+    if progress:
+        progress(result.imported + result.skipped, total, total)
+    return result
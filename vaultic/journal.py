@@ -0,0 +1,109 @@
+from __future__ import annotations
+import hashlib
+import os
+import struct
+import tempfile
+from pathlib import Path
+from typing import List, Tuple
+
+# vault.journal sits next to vault.png and holds the changes made since the
+# snapshot embedded in the image: a header naming that snapshot, then one
+# length prefixed, separately sealed delta per change. sealing and replay
+# live in vault.py, this module only frames bytes
+JOURNAL_MAGIC = b"VLTJ"
+JOURNAL_VERSION = 1
+BASE_BYTES = 16
+JOURNAL_HEADER = struct.Struct(f">4sB{BASE_BYTES}s")
+FRAME = struct.Struct(">I")
+
+
+# the journal on disk was started on another snapshot than the one read
+class StaleJournal(Exception):
+    pass
+
+
+# a journal only applies to the exact snapshot it was started on, once the
+# image is rewritten the old journal no longer matches and is ignored
+def snapshot_id(blob: bytes) -> bytes:
+    return hashlib.sha256(blob).digest()[:BASE_BYTES]
+
+
+# (offset, frame) for every complete frame plus the offset right after the
+# last one, ([], 0) when there is no journal. a frame cut short by a crash
+# (or still being appended) is left out, the next append overwrites it
+def read_frames(path: Path, base: bytes) -> Tuple[List[Tuple[int, bytes]], int]:
+    try:
+        raw = path.read_bytes()
+    except FileNotFoundError:
+        return [], 0
+    if len(raw) < JOURNAL_HEADER.size:
+        return [], 0
+    magic, version, journal_base = JOURNAL_HEADER.unpack_from(raw)
+    if magic != JOURNAL_MAGIC or version != JOURNAL_VERSION:
+        return [], 0
+    if journal_base != base:
+        raise StaleJournal()
+    frames = []
+    pos = JOURNAL_HEADER.size
+    while pos + FRAME.size <= len(raw):
+        (length,) = FRAME.unpack_from(raw, pos)
+        start = pos + FRAME.size
+        if start + length > len(raw):
+            break
+        frames.append((pos, raw[start:start + length]))
+        pos = start + length
+    return frames, pos
+
+
+def _fsync_dir(path: Path) -> None:
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+# frames go after the last good one (end), a journal that is missing or
+# stale is replaced as a whole with a fresh header. returns the new end
+def append_frames(path: Path, base: bytes, end: int, frames: List[bytes]) -> int:
+    body = b"".join(FRAME.pack(len(f)) + f for f in frames)
+    if end < JOURNAL_HEADER.size:
+        data = JOURNAL_HEADER.pack(JOURNAL_MAGIC, JOURNAL_VERSION, base) + body
+        fd, tmp = tempfile.mkstemp(prefix=".vaultic-", suffix=".journal", dir=path.parent)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+        _fsync_dir(path.parent)
+        return len(data)
+
+    with open(path, "r+b") as f:
+        f.truncate(end)
+        f.seek(end)
+        f.write(body)
+        f.flush()
+        os.fsync(f.fileno())
+    return end + len(body)
+
+
+# an empty journal for a freshly written snapshot, replacing the old one
+def reset(path: Path, base: bytes) -> int:
+    return append_frames(path, base, 0, [])
+
+
+# bytes of deltas waiting to be folded into the image
+def size(path: Path) -> int:
+    try:
+        return max(0, path.stat().st_size - JOURNAL_HEADER.size)
+    except FileNotFoundError:
+        return 0
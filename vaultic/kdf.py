@@ -0,0 +1,168 @@
+from __future__ import annotations
+import os
+import struct
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Tuple
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+from .payload import KDF_SCRYPT
+from .secret import wipe
+from .trace import traced
+
+# salt.bin used to be 16 raw bytes, it now starts with a header:
+# magic, version, kdf algorithm, log2(n), r, p, salt length, then the salt
+KDF_MAGIC = b"VKDF"
+KDF_VERSION = 1
+KDF_HEADER = struct.Struct(">4sBBBHHB")
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+# the parameters every vault used before they were stored with the salt
+DEFAULT_N = 2**14
+DEFAULT_R = 8
+DEFAULT_P = 1
+
+# calibration and explicit params stay within these. a machine too slow for
+# the old default gets down to 2^12, such params are weak and the cli says so
+MIN_LOG_N = 12
+MAX_LOG_N = 22
+DEFAULT_TARGET = 0.3
+DEFAULT_MAX_MEMORY = 64 * 1024 * 1024
+
+
+@dataclass(frozen=True)
+class KdfParams:
+    n: int = DEFAULT_N
+    r: int = DEFAULT_R
+    p: int = DEFAULT_P
+    algorithm: int = KDF_SCRYPT
+
+    # scrypt needs about 128 * r * n bytes per lane
+    @property
+    def memory(self) -> int:
+        return 128 * self.r * self.n * self.p
+
+    # cheaper than what every vault used before calibration existed, scrypt
+    # work grows with n * r * p
+    @property
+    def weak(self) -> bool:
+        return self.n * self.r * self.p < DEFAULT_N * DEFAULT_R * DEFAULT_P
+
+    def as_tuple(self) -> Tuple[int, int, int]:
+        return (self.n, self.r, self.p)
+
+    def __str__(self) -> str:
+        return f"scrypt n=2^{self.n.bit_length() - 1} r={self.r} p={self.p} ({self.memory // (1024 * 1024)} MiB)"
+
+
+def dump_salt(salt: bytes, params: KdfParams) -> bytes:
+    head = KDF_HEADER.pack(KDF_MAGIC, KDF_VERSION, params.algorithm, params.n.bit_length() - 1, params.r, params.p, len(salt))
+    return head + salt
+
+
+def parse_salt(raw: bytes) -> Tuple[bytes, KdfParams]:
+    if not raw.startswith(KDF_MAGIC):
+        # a bare salt from before the header existed
+        return raw, KdfParams()
+    if len(raw) < KDF_HEADER.size:
+        raise ValueError("salt.bin is corrupted")
+    _, version, algorithm, log_n, r, p, length = KDF_HEADER.unpack_from(raw)
+    if version != KDF_VERSION or algorithm != KDF_SCRYPT:
+        raise ValueError(f"unsupported kdf (version {version}, algorithm {algorithm})")
+    salt = raw[KDF_HEADER.size:KDF_HEADER.size + length]
+    if len(salt) != length:
+        raise ValueError("salt.bin is corrupted")
+    return salt, KdfParams(n=1 << log_n, r=r, p=p)
+
+
+def write_salt(path: Path, salt: bytes, params: KdfParams) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(dump_salt(salt, params))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+
+# create or load the salt and the parameters it was made for, a new salt
+# file gets params (or the defaults) written in front of it
+def load_kdf(path: Path, params: Optional[KdfParams] = None) -> Tuple[bytes, KdfParams]:
+    if path.exists():
+        return parse_salt(path.read_bytes())
+    salt = os.urandom(SALT_BYTES)
+    params = params or KdfParams()
+    write_salt(path, salt, params)
+    return salt, params
+
+
+# 32 byte key, in a bytearray the session wipes on lock (see secret.py).
+# cryptography releases without derive_into leave one more copy behind
+@traced("kdf.scrypt")
+def derive_key(master_key: str, salt: bytes, params: Optional[KdfParams] = None) -> bytearray:
+    params = params or KdfParams()
+    kdf = Scrypt(
+        salt=salt,
+        length=KEY_BYTES,
+        n=params.n,
+        r=params.r,
+        p=params.p
+    )
+    key = bytearray(KEY_BYTES)
+    material = bytearray(master_key, "utf-8")
+    try:
+        if hasattr(kdf, "derive_into"):
+            kdf.derive_into(material, key)
+        else:
+            key[:] = kdf.derive(material)
+    finally:
+        wipe(material)
+    return key
+
+
+# params asked for by hand, n as log2(n)
+def explicit(log_n: int, r: int = DEFAULT_R, p: int = DEFAULT_P) -> KdfParams:
+    if not MIN_LOG_N <= log_n <= MAX_LOG_N:
+        raise ValueError(f"log2(n) must be between {MIN_LOG_N} and {MAX_LOG_N}")
+    if not (1 <= r <= 0xFFFF and 1 <= p <= 0xFFFF):
+        raise ValueError("r and p must be between 1 and 65535")
+    return KdfParams(n=1 << log_n, r=r, p=p)
+
+
+# scrypt time grows linearly with n, so one timed derive at the minimum is
+# enough to pick the largest n that stays under target seconds and max_memory
+def calibrate(
+    target: float = DEFAULT_TARGET,
+    max_memory: int = DEFAULT_MAX_MEMORY,
+    r: int = DEFAULT_R,
+    p: int = DEFAULT_P,
+    min_log_n: int = MIN_LOG_N,
+) -> KdfParams:
+    salt = os.urandom(SALT_BYTES)
+    base = KdfParams(n=1 << min_log_n, r=r, p=p)
+    elapsed = min(_time_derive(salt, base) for _ in range(2))
+
+    log_n = min_log_n
+    while log_n < MAX_LOG_N:
+        bigger = KdfParams(n=1 << (log_n + 1), r=r, p=p)
+        if bigger.memory > max_memory or elapsed * (bigger.n / base.n) > target:
+            break
+        log_n += 1
+    params = KdfParams(n=1 << log_n, r=r, p=p)
+
+    # the estimate ignores cache effects at larger n, check it once
+    while params.n > base.n and _time_derive(salt, params) > target * 1.5:
+        params = KdfParams(n=params.n >> 1, r=r, p=p)
+    return params
+
+
+def _time_derive(salt: bytes, params: KdfParams) -> float:
+    start = time.perf_counter()
+    derive_key("calibration", salt, params)
+    return time.perf_counter() - start
@@ -0,0 +1,59 @@
+from __future__ import annotations
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+try:
+    import fcntl
+except ImportError:
+    # windows
+    fcntl = None
+    import msvcrt
+
+LOCK_TIMEOUT = 30.0
+POLL = 0.02
+
+
+class VaultBusy(TimeoutError):
+    pass
+
+
+def _try_lock(fd: int) -> bool:
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+
+def _release(fd: int) -> None:
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+# advisory lock held by whoever is writing the vault, readers never take it.
+# the lock file is left in place, only the lock on it matters
+@contextmanager
+def writer_lock(path: Path, timeout: float = LOCK_TIMEOUT) -> Iterator[None]:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        deadline = time.monotonic() + timeout
+        while not _try_lock(fd):
+            if time.monotonic() >= deadline:
+                raise VaultBusy(f"vault is busy, {path} is held by another vaultic process")
+            time.sleep(POLL)
+        try:
+            yield
+        finally:
+            _release(fd)
+    finally:
+        os.close(fd)
@@ -1,32 +1,145 @@
-import requests
-from PIL import Image
+import os
+import threading
+import uuid
 from io import BytesIO
+from pathlib import Path
+from typing import Optional
 
-def meme():
-    url = "https://meme-api.com/gimme"
+DEFAULT_API = "https://meme-api.com"
+# (connect, read) seconds
+TIMEOUT = (5, 20)
+
+# one pooled session per fetcher, retries with backoff on flaky responses and
+# VAULTIC_MEME_API (or base_url) points it somewhere else, e.g. a local server.
+# requests and pillow load with the first fetcher, the app starts without them
+class MemeFetcher:
+
+    def __init__(self, base_url: Optional[str] = None, timeout=TIMEOUT, retries: int = 3, backoff: float = 0.5):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        self.base_url = (base_url or os.environ.get("VAULTIC_MEME_API") or DEFAULT_API).rstrip("/")
+        self.timeout = timeout
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("GET",),
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
-    try:
-        response = requests.get(url)
+    def meme_url(self) -> Optional[str]:
+        response = self.session.get(f"{self.base_url}/gimme", timeout=self.timeout)
         response.raise_for_status()
-        data = response.json()
-        url = data.get("url")
-
-        if url:
-            return url
-    
-    except Exception as e:
-        print(e)
-        return None
-    
-def download(url, path):
-    try:
-        response = requests.get(url)
+        return response.json().get("url")
+
+    def download(self, url: str, path: str | Path) -> Path:
+        from PIL import Image
+        path = Path(path)
+        response = self.session.get(url, timeout=self.timeout)
         response.raise_for_status()
         image = Image.open(BytesIO(response.content))
-        image.save(path, format="PNG")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.part")
+        image.save(tmp, format="PNG")
+        os.replace(tmp, path)
         return path
 
-    except Exception as e:
-        print(e)
+    def fetch(self, path: str | Path) -> Path:
+        url = self.meme_url()
+        if not url:
+            raise ValueError("meme api returned no image url")
+        return self.download(url, path)
+
+    def close(self) -> None:
+        self.session.close()
+
+_fetcher: Optional[MemeFetcher] = None
+
+def fetcher() -> MemeFetcher:
+    global _fetcher
+    if _fetcher is None:
+        _fetcher = MemeFetcher()
+    return _fetcher
+
+# errors are the caller's to report, they run under a tui that printing
+# would scribble over
+def meme():
+    return fetcher().meme_url()
+
+def download(url, path):
+    return str(fetcher().download(url, path))
+
+
+# covers fetched ahead of time into ~/.vaultic/covers/, least recently
+# fetched ones are evicted once the count or size cap is passed
+class CoverCache:
+
+    def __init__(self, directory: Path, keep: int = 3, max_bytes: int = 50 * 1024 * 1024, fetcher: Optional[MemeFetcher] = None):
+        self.dir = Path(directory)
+        self.keep = keep
+        self.max_bytes = max_bytes
+        self._fetcher = fetcher
+        self._filling = threading.Lock()
+        # why the last fill stopped early, None once one completes
+        self.error: Optional[Exception] = None
+
+    @property
+    def fetcher(self) -> MemeFetcher:
+        if self._fetcher is None:
+            self._fetcher = fetcher()
+        return self._fetcher
+
+    # oldest first
+    def covers(self) -> list[Path]:
+        if not self.dir.exists():
+            return []
+        found = [p for p in self.dir.glob("*.png") if not p.name.startswith(".")]
+        return sorted(found, key=lambda p: p.stat().st_mtime_ns)
+
+    def evict(self) -> None:
+        covers = self.covers()
+        total = sum(p.stat().st_size for p in covers)
+        while covers and (len(covers) > self.keep or total > self.max_bytes):
+            oldest = covers.pop(0)
+            total -= oldest.stat().st_size
+            oldest.unlink(missing_ok=True)
+
+    def fill(self) -> int:
+        if not self._filling.acquire(blocking=False):
+            return 0
+        added = 0
+        try:
+            while len(self.covers()) < self.keep:
+                self.fetcher.fetch(self.dir / f"{uuid.uuid4().hex}.png")
+                added += 1
+            self.evict()
+            self.error = None
+        except Exception as e:
+            self.error = e
+        finally:
+            self._filling.release()
+        return added
+
+    def prefetch(self) -> threading.Thread:
+        thread = threading.Thread(target=self.fill, name="vaultic-cover-prefetch", daemon=True)
+        thread.start()
+        return thread
+
+    # most recently fetched cover moved to dest, None when the cache is empty
+    def take(self, dest: str | Path) -> Optional[Path]:
+        dest = Path(dest)
+        for cover in reversed(self.covers()):
+            try:
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(cover, dest)
+                return dest
+            except FileNotFoundError:
+                continue
         return None
 
+    def get(self, dest: str | Path) -> Path:
+        return self.take(dest) or self.fetcher.fetch(dest)
@@ -0,0 +1,183 @@
+from __future__ import annotations
+import functools
+import math
+import os
+import string
+from dataclasses import dataclass
+from itertools import combinations
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
+from .trace import traced
+
+# passwords and passphrases for the store screen, `vaultic gen` and imports.
+# a batch reads os.urandom once, large enough for every character in it, and
+# bytes.translate maps the random bytes onto the alphabet and drops the ones
+# that would bias it, so there is no python level work per character
+
+SYMBOLS = "!@#$%^&*()-_=+[]{};:,.?/"
+CLASSES = {
+    "lower": string.ascii_lowercase,
+    "upper": string.ascii_uppercase,
+    "digits": string.digits,
+    "symbols": SYMBOLS,
+}
+# easy to misread on a screen or a printout
+LOOKALIKE = "Il1|O0o"
+WORDLIST = Path(__file__).with_name("wordlist.txt")
+
+MAX_LENGTH = 1024
+# smallest urandom read, a single password still costs one syscall
+MIN_READ = 512
+# passwords drawn at a time by stream()
+STREAM_BATCH = 256
+
+RandBytes = Callable[[int], bytes]
+
+
+@dataclass(frozen=True)
+class Policy:
+    length: int = 16
+    classes: Tuple[str, ...] = tuple(CLASSES)
+    # every class shows up at least once
+    require: bool = True
+    exclude_lookalike: bool = False
+    exclude: str = ""
+
+    def __post_init__(self):
+        unknown = [c for c in self.classes if c not in CLASSES]
+        if unknown:
+            raise ValueError(f"unknown character class {unknown[0]!r}, use {', '.join(CLASSES)}")
+        groups = self.groups()
+        if not groups or (self.require and len(groups) < len(set(self.classes))):
+            raise ValueError("the excluded characters empty a character class")
+        if not 1 <= self.length <= MAX_LENGTH:
+            raise ValueError(f"length must be between 1 and {MAX_LENGTH}")
+        if self.require and self.length < len(groups):
+            raise ValueError(f"length must be at least {len(groups)} to fit every class")
+
+    # the allowed characters of each class, classes left empty are dropped
+    def groups(self) -> List[str]:
+        drop = set(self.exclude) | (set(LOOKALIKE) if self.exclude_lookalike else set())
+        groups = []
+        for name in dict.fromkeys(self.classes):
+            chars = "".join(c for c in CLASSES[name] if c not in drop)
+            if chars:
+                groups.append(chars)
+        return groups
+
+    @property
+    def alphabet(self) -> str:
+        return "".join(self.groups())
+
+    # log2 of how many passwords the policy allows, all equally likely. with
+    # require, inclusion-exclusion takes out the ones missing some class
+    def entropy(self) -> float:
+        sizes = [len(g) for g in self.groups()]
+        total = sum(sizes)
+        if not self.require:
+            return self.length * math.log2(total)
+        count = 0
+        for k in range(len(sizes) + 1):
+            for subset in combinations(sizes, k):
+                count += (-1) ** k * (total - sum(subset)) ** self.length
+        return math.log2(count)
+
+
+@dataclass
+class Generated:
+    password: str
+    bits: float
+
+
+# n characters drawn uniformly from an ascii alphabet. bytes from the largest
+# multiple of len(alphabet) up are rejected, the rest are taken modulo it
+def _sample(alphabet: str, n: int, randbytes: RandBytes) -> str:
+    k = len(alphabet)
+    limit = 256 - 256 % k
+    table = bytes(ord(alphabet[i % k]) for i in range(256))
+    reject = bytes(range(limit, 256))
+    chunks = []
+    have = 0
+    while have < n:
+        # over-read by the rejection rate so one read is nearly always enough
+        want = max(MIN_READ, (n - have) * 256 // limit * 9 // 8 + 16)
+        chunk = randbytes(want).translate(table, reject)
+        chunks.append(chunk)
+        have += len(chunk)
+    return b"".join(chunks)[:n].decode("ascii")
+
+
+# n indices below k for lists too long for one byte, two bytes per pick
+def _indices(k: int, n: int, randbytes: RandBytes) -> List[int]:
+    limit = 65536 - 65536 % k
+    picks: List[int] = []
+    while len(picks) < n:
+        want = max(MIN_READ, (n - len(picks)) * 65536 // limit * 9 // 8 + 8)
+        for v in memoryview(randbytes(want * 2)).cast("H"):
+            if v < limit:
+                picks.append(v % k)
+    return picks[:n]
+
+
+@traced("passgen.passwords")
+def passwords(policy: Optional[Policy] = None, count: int = 1, randbytes: RandBytes = os.urandom) -> List[Generated]:
+    policy = policy or Policy()
+    alphabet = policy.alphabet
+    bits = policy.entropy()
+    length = policy.length
+    groups = [frozenset(g) for g in policy.groups()] if policy.require else []
+    # share of uniform strings that satisfy the policy, candidates missing a
+    # class are thrown away whole so the survivors stay uniform
+    accept = 2 ** (bits - length * math.log2(len(alphabet)))
+
+    out: List[Generated] = []
+    while len(out) < count:
+        batch = math.ceil((count - len(out)) / accept * 1.1)
+        chars = _sample(alphabet, batch * length, randbytes)
+        for i in range(0, len(chars), length):
+            candidate = chars[i:i + length]
+            if all(not g.isdisjoint(candidate) for g in groups):
+                out.append(Generated(candidate, bits))
+                if len(out) == count:
+                    break
+    return out
+
+
+# endless supply for callers that need one password at a time, still read
+# from urandom in batches
+def stream(policy: Optional[Policy] = None, batch: int = STREAM_BATCH, randbytes: RandBytes = os.urandom) -> Iterator[Generated]:
+    while True:
+        yield from passwords(policy, batch, randbytes)
+
+
+# the bundled list, blank lines, # comments and repeats are skipped so a
+# duplicated word can't silently shrink the entropy
+@functools.lru_cache(maxsize=1)
+def wordlist() -> Tuple[str, ...]:
+    words = []
+    for line in WORDLIST.read_text(encoding="utf-8").splitlines():
+        word = line.strip().lower()
+        if word and not word.startswith("#"):
+            words.append(word)
+    return tuple(dict.fromkeys(words))
+
+
+@traced("passgen.passphrases")
+def passphrases(
+    words: int = 6,
+    count: int = 1,
+    sep: str = "-",
+    vocabulary: Optional[Sequence[str]] = None,
+    randbytes: RandBytes = os.urandom,
+) -> List[Generated]:
+    vocabulary = list(dict.fromkeys(vocabulary)) if vocabulary is not None else wordlist()
+    if not 2 <= len(vocabulary) <= 65536:
+        raise ValueError("the wordlist needs between 2 and 65536 distinct words")
+    if not 1 <= words <= MAX_LENGTH:
+        raise ValueError(f"words must be between 1 and {MAX_LENGTH}")
+    bits = words * math.log2(len(vocabulary))
+    picks = _indices(len(vocabulary), words * count, randbytes)
+    return [
+        Generated(sep.join(vocabulary[i] for i in picks[n:n + words]), bits)
+        for n in range(0, words * count, words)
+    ]
@@ -0,0 +1,139 @@
+from __future__ import annotations
+import json
+import struct
+import zlib
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+from .secret import wipe
+
+MAGIC = b"VLTC"
+VERSION = 3
+# vault.png of a sharded vault: the index is the sealed shard manifest and
+# there are no records, see shards.py
+MANIFEST_VERSION = 4
+
+# magic, version, reserved, kdf algorithm, log2(n), r, p
+HEADER = struct.Struct(">4sBBBBHH")
+KDF_SCRYPT = 1
+
+# first plaintext byte of every sealed piece says how the rest is encoded
+CODEC_JSON = 0
+CODEC_ZLIB = 1
+
+# on disk vault layout: a sealed index (service names, entry ids, metadata)
+# plus one separately sealed record per entry, keyed by entry id
+@dataclass
+class Payload:
+    index: bytes
+    records: Dict[str, bytes] = field(default_factory=dict)
+    kdf: Tuple[int, int, int] = (2**14, 8, 1)
+    version: int = VERSION
+
+# compact json, deflated when that actually makes it smaller. a bytearray
+# so seal() can wipe it once it is encrypted
+def encode_plain(data: Dict) -> bytearray:
+    return deflate_plain(dump_plain(data))
+
+# the json codec form, what encode_plain starts from. its length bounds the
+# encoded one, deflate is only kept when it comes out smaller
+def dump_plain(data: Dict) -> bytearray:
+    raw = bytearray([CODEC_JSON])
+    raw += json.dumps(data, separators=(",", ":")).encode("utf-8")
+    return raw
+
+# raw (from dump_plain) or its deflated form, whichever is smaller. the
+# other one is wiped
+def deflate_plain(raw: bytearray) -> bytearray:
+    # window and hash table sized to the input, zlib's defaults allocate
+    # ~260 KiB per call even for one record. the stream header carries the
+    # window size, decode_plain needs nothing special
+    wbits = min(15, max(9, (len(raw) - 2).bit_length()))
+    deflate = zlib.compressobj(6, zlib.DEFLATED, wbits, max(1, min(8, wbits - 7)))
+    packed = bytearray([CODEC_ZLIB])
+    packed += deflate.compress(memoryview(raw)[1:])
+    packed += deflate.flush()
+    if len(packed) < len(raw):
+        wipe(raw)
+        return packed
+    wipe(packed)
+    return raw
+
+# plain is usually a view of a scratch buffer (see unseal), decoded straight
+# from it without slicing off a copy
+def decode_plain(plain: bytes | memoryview) -> Dict:
+    codec, body = plain[0], memoryview(plain)[1:]
+    if codec == CODEC_ZLIB:
+        return json.loads(zlib.decompress(body))
+    elif codec != CODEC_JSON:
+        raise ValueError(f"unknown vault codec {codec}")
+    return json.loads(str(body, "utf-8"))
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def _read_varint(view: memoryview, pos: int) -> Tuple[int, int]:
+    n = shift = 0
+    while True:
+        byte = view[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+# records are framed as id length, raw id bytes (entry ids are hex), varint
+# record length and the sealed record
+def pack(payload: Payload) -> bytes:
+    if payload.version not in (VERSION, MANIFEST_VERSION):
+        raise ValueError(f"can't write vault format version {payload.version}")
+    n, r, p = payload.kdf
+    parts = [
+        HEADER.pack(MAGIC, payload.version, 0, KDF_SCRYPT, n.bit_length() - 1, r, p),
+        _varint(len(payload.index)),
+        payload.index,
+        _varint(len(payload.records)),
+    ]
+    for entry_id, record in payload.records.items():
+        raw_id = bytes.fromhex(entry_id)
+        parts.append(bytes([len(raw_id)]))
+        parts.append(raw_id)
+        parts.append(_varint(len(record)))
+        parts.append(record)
+    return b"".join(parts)
+
+def _unpack_body(view: memoryview, pos: int) -> Tuple[bytes, Dict[str, bytes]]:
+    try:
+        index_len, pos = _read_varint(view, pos)
+        index = bytes(view[pos:pos + index_len])
+        pos += index_len
+        count, pos = _read_varint(view, pos)
+        records = {}
+        for _ in range(count):
+            id_len = view[pos]
+            entry_id = view[pos + 1:pos + 1 + id_len].hex()
+            rec_len, pos = _read_varint(view, pos + 1 + id_len)
+            records[entry_id] = bytes(view[pos:pos + rec_len])
+            pos += rec_len
+    except IndexError:
+        raise ValueError("vault data is corrupted")
+    if pos != len(view) or len(index) != index_len:
+        raise ValueError("vault data is corrupted")
+    return index, records
+
+# None means the blob is an old single blob vault (nonce + ciphertext)
+def unpack(blob: bytes) -> Optional[Payload]:
+    view = memoryview(blob)
+    if not blob.startswith(MAGIC):
+        return None
+    if len(blob) < HEADER.size:
+        raise ValueError("vault data is corrupted")
+    _, version, _, algorithm, log_n, r, p = HEADER.unpack_from(view)
+    if version not in (VERSION, MANIFEST_VERSION) or algorithm != KDF_SCRYPT:
+        raise ValueError(f"unsupported vault format (version {version})")
+    index, records = _unpack_body(view, HEADER.size)
+    return Payload(index=index, records=records, kdf=(1 << log_n, r, p), version=version)
@@ -0,0 +1,81 @@
+from __future__ import annotations
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional, Tuple
+
+# pillow and rich_pixels load with the first preview, after the home screen
+# painted, not with the app
+if TYPE_CHECKING:
+    from PIL import Image
+    from rich_pixels import Pixels
+
+# the preview never needs more than this many source pixels per side
+THUMB_SIDE = 256
+
+def center_square(img: Image.Image) -> Image.Image:
+    w, h = img.size
+    side = min(w, h)
+    left = (w - side) // 2
+    top = (h - side) // 2
+    return img.crop((left, top, left + side, top + side))
+
+# draft() lets jpeg decode at 1/2..1/8 scale, reduce() then shrinks by whole
+# factors which is much cheaper than a full resample of the original
+def load_thumbnail(path: str | Path, side: int = THUMB_SIDE) -> Image.Image:
+    from PIL import Image
+    with Image.open(path) as img:
+        img.draft("RGB", (side, side))
+        img = center_square(img.convert("RGB"))
+    factor = img.width // side
+    if factor > 1:
+        img = img.reduce(factor)
+    if img.width > side:
+        img = img.resize((side, side), Image.Resampling.LANCZOS)
+    return img
+
+# rendered previews per (side, file stat), the thumbnail is decoded once per
+# version of the file and every cached size is dropped when the file changes.
+# rendered on worker threads, a superseded render may still be running
+class PreviewCache:
+
+    def __init__(self, max_sizes: int = 8):
+        self.max_sizes = max_sizes
+        self._stat: Optional[Tuple[str, int, int]] = None
+        self._thumb: Optional[Image.Image] = None
+        self._pixels: OrderedDict[int, Pixels] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _check(self, path: Path) -> None:
+        st = os.stat(path)
+        stat = (str(path), st.st_mtime_ns, st.st_size)
+        if stat != self._stat:
+            self._stat = stat
+            self._thumb = None
+            self._pixels.clear()
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._stat = None
+            self._thumb = None
+            self._pixels.clear()
+
+    def pixels(self, path: str | Path, side: int) -> Pixels:
+        with self._lock:
+            return self._render(Path(path), side)
+
+    def _render(self, path: Path, side: int) -> Pixels:
+        from rich_pixels import Pixels
+        self._check(path)
+        cached = self._pixels.get(side)
+        if cached is not None:
+            self._pixels.move_to_end(side)
+            return cached
+        if self._thumb is None:
+            self._thumb = load_thumbnail(path)
+        rendered = Pixels.from_image(self._thumb, resize=(side, side))
+        self._pixels[side] = rendered
+        while len(self._pixels) > self.max_sizes:
+            self._pixels.popitem(last=False)
+        return rendered
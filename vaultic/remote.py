@@ -0,0 +1,160 @@
+from __future__ import annotations
+import json
+import os
+import socket
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+from cryptography.exceptions import InvalidTag
+from .session import SessionLocked
+from .vault import VaultPaths, default
+
+# client side of the agent (see agent.py), kept free of asyncio so the cli
+# and tui can probe for a running agent without paying for the event loop
+
+SOCKET_NAME = "agent.sock"
+CONNECT_TIMEOUT = 0.5
+# unlock and large imports run scrypt or rewrite the png on the agent side
+REQUEST_TIMEOUT = 120
+
+
+class AgentError(Exception):
+    pass
+
+
+def socket_path(paths: Optional[VaultPaths] = None) -> Path:
+    env = os.environ.get("VAULTIC_AGENT_SOCK")
+    if env:
+        return Path(env)
+    return (paths or default()).dir / SOCKET_NAME
+
+
+# one json object per line each way, requests from worker threads are
+# serialised so replies can't interleave
+class AgentClient:
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self._file = sock.makefile("rwb")
+        self._lock = threading.Lock()
+
+    def request(self, op: str, **args):
+        with self._lock:
+            self._file.write(json.dumps({"op": op, **args}).encode("utf-8") + b"\n")
+            self._file.flush()
+            line = self._file.readline()
+        if not line:
+            raise AgentError("agent closed the connection")
+        reply = json.loads(line)
+        if reply.get("ok"):
+            return reply.get("result")
+        kind, message = reply.get("kind"), reply.get("error") or "agent error"
+        if kind == "locked":
+            raise SessionLocked(message)
+        if kind == "wrong_master":
+            raise InvalidTag()
+        if kind == "not_found":
+            raise FileNotFoundError(message)
+        raise AgentError(message)
+
+    def status(self) -> Dict:
+        return self.request("status")
+
+    def close(self) -> None:
+        try:
+            self._file.close()
+        finally:
+            self.sock.close()
+
+
+def connect(path: Optional[Path] = None) -> Optional[AgentClient]:
+    path = path or socket_path()
+    if not path.exists():
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CONNECT_TIMEOUT)
+    try:
+        sock.connect(str(path))
+    except OSError:
+        sock.close()
+        return None
+    sock.settimeout(REQUEST_TIMEOUT)
+    return AgentClient(sock)
+
+
+# the parts of Vault the screens, cli and importer use, answered by the agent
+class RemoteVault:
+
+    def __init__(self, client: AgentClient):
+        self.client = client
+
+    def list_services(self) -> List[str]:
+        return self.client.request("list")
+
+    def get_entry(self, service: str) -> Optional[Dict]:
+        return self.client.request("get", service=service)
+
+    def add_entry(self, service: str, password: str) -> None:
+        self.client.request("apply", changes=[["add", service, password]])
+
+    def update_entry(self, service: str, password: str) -> None:
+        self.add_entry(service, password)
+
+    def delete_entry(self, service: str) -> bool:
+        return self.client.request("apply", changes=[["rm", service]])[0]
+
+    def history(self, service: str) -> List[Dict]:
+        return self.client.request("history", service=service)
+
+    def restore(self, service: str, n: int) -> bool:
+        return self.client.request("apply", changes=[["restore", service, n]])[0]
+
+    def compact(self) -> bool:
+        return self.client.request("compact")
+
+    def verify_master(self) -> None:
+        if not self.client.status()["unlocked"]:
+            raise SessionLocked("agent is locked")
+
+    # queued locally and sent as one apply, so the agent writes the png once
+    @contextmanager
+    def batch(self) -> Iterator["RemoteBatch"]:
+        tx = RemoteBatch(self, self.list_services())
+        yield tx
+        if tx.changes:
+            self.client.request("apply", changes=tx.changes)
+
+
+class RemoteBatch:
+
+    def __init__(self, vault: RemoteVault, services: List[str]):
+        self.vault = vault
+        self._services = set(services)
+        self.changes: List[List[str]] = []
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self.changes)
+
+    def add(self, service: str, password: str) -> None:
+        self.changes.append(["add", service, password])
+        self._services.add(service.strip().lower())
+
+    def update(self, service: str, password: str) -> None:
+        self.add(service, password)
+
+    def delete(self, service: str) -> bool:
+        service = service.strip().lower()
+        if service not in self._services:
+            return False
+        self.changes.append(["rm", service])
+        self._services.discard(service)
+        return True
+
+    # pending adds are not visible until the batch is applied
+    def get(self, service: str) -> Optional[Dict]:
+        return self.vault.get_entry(service)
+
+    def services(self) -> List[str]:
+        return sorted(self._services)
@@ -1,21 +1,120 @@
 from textual.containers import Container, Vertical, Horizontal
-from textual.widgets import Static, Input, Button, ListView, ListItem
-from textual.screen import Screen
-from cryptography.exceptions import InvalidTag
-from .vault import Vault
-from .meme import meme as meme_url, download
+from textual.widgets import Static, Input, Button, OptionList, ProgressBar, Checkbox
+from textual.widgets.option_list import Option
+from textual.screen import Screen, ModalScreen
+from textual.message import Message
+from textual.worker import get_current_worker
 from pathlib import Path
-from .vault import default
-from rich_pixels import Pixels
-from PIL import Image
-import secrets 
-import string
-import pyperclip
-
-class HomeScreen(Screen):
+from .passgen import MAX_LENGTH, Generated, Policy, passwords
+from .preview import PreviewCache
+from .search import ServiceIndex
+from .trace import tracer, sparkline, BUCKETS_MS
+from rich.table import Table
+import time
+
+# the session, vault, importer, cryptography and pyperclip are imported
+# where first used: the home screen paints before any of them load, and an
+# error from them can only arrive once they did
+
+
+# posted back to the screen by a finished background task
+class TaskDone(Message):
+    def __init__(self, task: str, result=None, error: Exception | None = None) -> None:
+        super().__init__()
+        self.task = task
+        self.result = result
+        self.error = error
+
+
+class TaskProgress(Message):
+    def __init__(self, task: str, text: str, done: int | None = None, total: int | None = None) -> None:
+        super().__init__()
+        self.task = task
+        self.text = text
+        self.done = done
+        self.total = total
+
+
+# runs scrypt, png i/o and network calls on worker threads so the event loop
+# keeps painting, a new task of the same name supersedes the running one
+class TaskScreen(Screen):
+
+    # label None leaves the status line alone, for work the user didn't ask for
+    def start_task(self, task: str, fn, *args, label: str | None = "working…") -> None:
+        if label is not None:
+            self.query_one("#status", Static).update(label)
+        self.run_worker(lambda: self._run_task(task, fn, args), thread=True, exclusive=True, group=task)
+
+    def cancel_task(self, task: str) -> None:
+        self.workers.cancel_group(self, task)
+
+    def _run_task(self, task: str, fn, args) -> None:
+        worker = get_current_worker()
+        try:
+            result, error = fn(*args), None
+        except Exception as e:
+            result, error = None, e
+        if not worker.is_cancelled:
+            self.post_message(TaskDone(task, result, error))
+
+    # safe to call from a task while it runs
+    def report(self, task: str, text: str, done: int | None = None, total: int | None = None) -> None:
+        if not get_current_worker().is_cancelled:
+            self.post_message(TaskProgress(task, text, done, total))
+
+    def on_task_progress(self, message: TaskProgress) -> None:
+        self.query_one("#status", Static).update(message.text)
+
+    # common failures, returns False when the error was a lock
+    def show_error(self, error: Exception, wrong_master: str = "wrong master password") -> bool:
+        from cryptography.exceptions import InvalidTag
+        from .session import SessionLocked
+        if isinstance(error, SessionLocked):
+            self.app.lock_screens(str(error))
+            return False
+        if isinstance(error, FileNotFoundError):
+            self.query_one("#status", Static).update("create vault meme first")
+        elif isinstance(error, InvalidTag):
+            self.query_one("#status", Static).update(wrong_master)
+        else:
+            self.query_one("#status", Static).update(f"error: {error}")
+        return True
+
+    # re-checking the master runs scrypt, so it happens on the worker too
+    def confirmed(self, master_confirm: str, fn, *args):
+        from cryptography.exceptions import InvalidTag
+        session = self.app.session
+        if not session.check(master_confirm):
+            raise InvalidTag()
+        return fn(session.vault(), *args)
+
+
+# resize events closer together than this only render the preview once
+PREVIEW_DEBOUNCE = 0.15
+
+# rebuilding the option list takes from a few ms up to a couple hundred for
+# thousands of matches, keystrokes closer together than this only rebuild it
+# once typing pauses
+SEARCH_DEBOUNCE = 0.08
+
+
+# the app's service index, sorted and with its trigram table built so the
+# first search typed pays for neither. runs on a worker
+def load_services(vault) -> ServiceIndex:
+    index = ServiceIndex(vault.list_services())
+    index.warm()
+    return index
+
+
+# paints with placeholders first, then looks for the vault (and an unlocked
+# agent) and renders the preview on workers
+class HomeScreen(TaskScreen):
     def __init__(self) -> None:
         super().__init__()
         self.unlocked = False
+        self.probed = False
+        self.previews = PreviewCache()
+        self._preview_timer = None
 
     def compose(self):
 
@@ -28,139 +127,223 @@ class HomeScreen(Screen):
                 with Container(id="panel"):
                     yield Static("enter your master password to continue", id="subtitle")
                     yield Input(placeholder="master password", password=True, id="master")
+                    yield Checkbox("hide the vault in the pixels (survives metadata stripping)", id="pixel-mode")
 
                     with Vertical(id="menu-buttons"):
-                        yield Button("create vault meme", id="create-vault", classes="buttons")
-                        yield Button("unlock", id="unlock", classes="buttons")
+                        yield Button("create vault meme", id="create-vault", classes="buttons", disabled=True)
+                        yield Button("unlock", id="unlock", classes="buttons", disabled=True)
                         yield Button("store a password", id="go-store", classes="buttons", disabled=True)
                         yield Button("retrieve a password", id="go-get", classes="buttons", disabled=True)
+                        yield Button("import passwords", id="go-import", classes="buttons", disabled=True)
+                        yield Button("lock", id="lock", classes="buttons", disabled=True)
                     
-                    yield Static("", id="status", classes="box")
+                    yield Static("looking for your vault…", id="status", classes="box")
                 
                 with Container(id="meme"):
                     with Vertical(id="meme-vert"):
-                        yield Static("", id="meme-view")
+                        yield Static("loading preview…", id="meme-view")
                         with Horizontal(id="meme-row"):
                             yield Button("open meme", id="preview", classes="buttons")
                     
                 
 
     def on_mount(self):
-        exists = default().vault_file.exists()
+        if self.app.profile:
+            self.app.profile.mark("home screen mounted")
+        self.call_after_refresh(self.first_paint)
+
+    def first_paint(self) -> None:
+        if self.app.profile:
+            self.app.profile.mark("first paint")
+        self.start_task("probe", self.probe, label=None)
+
+    # creating the session imports cryptography, the agent check is a socket
+    # round trip: (vault exists, unlocked by the agent)
+    def probe(self) -> tuple[bool, bool]:
+        session = self.app.session
+        exists = session.paths.vault_file.exists()
+        return exists, exists and session.attach_agent()
+
+    def probe_done(self, exists: bool, attached: bool) -> None:
+        if self.app.profile:
+            self.app.profile.mark("vault found" if exists else "no vault")
+        self.probed = True
         self.query_one("#create-vault", Button).disabled = exists
-        if exists:
+        self.query_one("#unlock", Button).disabled = False
+        self.query_one("#pixel-mode", Checkbox).display = not exists
+        if attached:
+            self._set_unlocked(True)
+            self.query_one("#status", Static).update("unlocked by the running vaultic agent")
+        elif exists:
             self.query_one("#status", Static).update("vault exists, enter your master password and click unlock")
         else:
             self.query_one("#status", Static).update("no vault meme found, create one!")
+            # a profiling run quits right away, no downloads behind it
+            if not self.app.profile:
+                self.app.covers.prefetch()
         self.update_preview()
 
-    def center_square(self, img: Image.Image) -> Image.Image:
-        w, h = img.size
-        side = min(w, h)
-        left = (w - side) // 2
-        top = (h - side) // 2
-        return img.crop((left, top, left + side, top + side))
-
     def update_preview(self):
-        vault_path = default().vault_file
+        if not self.probed:
+            return
+        vault_path = self.app.session.paths.vault_file
         meme_view = self.query_one("#meme-view", Static)
 
         if not vault_path.exists():
             meme_view.update("no vault meme yet, create one!")
+            self.preview_done()
             return
         
-        try:
-            w = max(10, meme_view.size.width)
-            h = max(10, meme_view.size.height)            
+        w = max(10, meme_view.size.width)
+        h = max(10, meme_view.size.height)            
 
-            # margin so no clip
-            w -= 1
-            h -= 1
+        # margin so no clip
+        w -= 1
+        h -= 1
 
-            side = max(10, min(w, h))
+        side = max(10, min(w, h))
 
-            img = Image.open(vault_path).convert("RGB")
-            img = self.center_square(img)
-            meme_view.update(Pixels.from_image(img, resize=(side, side)))
-        except Exception as e:
-            print(e)
-            meme_view.update(str(e))
+        # decoding the png can take a while, the event loop keeps painting
+        self.start_task("preview", self.previews.pixels, vault_path, side, label=None)
+
+    def preview_done(self) -> None:
+        if self.app.profile:
+            self.app.profile.mark("preview loaded")
+            self.app.exit()
 
     def on_resize(self):
-        self.update_preview()
+        if self._preview_timer is not None:
+            self._preview_timer.stop()
+        self._preview_timer = self.set_timer(PREVIEW_DEBOUNCE, self.update_preview)
 
 
     def _set_unlocked(self, unlocked: bool) -> None:
         self.unlocked = unlocked
         self.query_one("#go-store", Button).disabled = not unlocked
         self.query_one("#go-get", Button).disabled = not unlocked
+        self.query_one("#go-import", Button).disabled = not unlocked
+        self.query_one("#lock", Button).disabled = not unlocked
+
+    def locked(self, message: str) -> None:
+        self.app.services = None
+        self._set_unlocked(False)
+        self.query_one("#master", Input).value = ""
+        self.query_one("#status", Static).update(message)
+
+    def on_screen_resume(self) -> None:
+        if self.unlocked and not self.app.session.unlocked:
+            self.locked("vault locked after inactivity")
 
     def on_button_pressed(self, event: Button.Pressed) -> None:
+        session = self.app.session
+
+        if event.button.id == "lock":
+            self.app.action_lock()
+            return
+
+        if event.button.id in ("go-store", "go-get", "go-import"):
+            if not session.unlocked:
+                self.locked("unlock first")
+                return
+            if event.button.id == "go-store":
+                self.app.push_screen(StoreScreen())
+            elif event.button.id == "go-get":
+                self.app.push_screen(GetScreen())
+            else:
+                self.app.push_screen(ImportScreen())
+            return
+
         master = self.query_one("#master", Input).value
         if not master:
             self.query_one("#status", Static).update("enter master password!")
             return
 
         if event.button.id == "preview":
-            path = default().vault_file.resolve()
+            path = session.paths.vault_file.resolve()
             self.app.open_url(f"file://{path}")
             self.query_one("#status", Static).update("opened preview")
             return
 
         if event.button.id == "create-vault":
-            try:
-                url = meme_url()
-                if not url:
-                    self.query_one("#status", Static).update("failed to fetch meme")
-                    return
-
-                cover_path = Path.home() / ".vaultic" / "cover.png"
-                out = download(url, str(cover_path))
-                if not out:
-                    self.query_one("#status", Static).update("failed to download meme")
-                    return
-
-                v = Vault(master)
-                v.create_meme(cover_path)
-                self._set_unlocked(False)
-                self.query_one("#status", Static).update("vault meme created at ~/.vaultic/vault.png")
-                self.query_one("#create-vault", Button).disabled = True
-                self.update_preview()
-            except Exception as e:
-                self.query_one("#status", Static).update(str(e))
+            from .vault import CHUNK_MODE, PIXEL_MODE
+            mode = PIXEL_MODE if self.query_one("#pixel-mode", Checkbox).value else CHUNK_MODE
+            self.start_task("create", self.create_vault, master, mode, label="fetching a meme…")
             return
 
         if event.button.id == "unlock":
-            try:
-                v = Vault(master)
-                v.verify_master()
-                self._set_unlocked(True)
-                self.query_one("#status", Static).update("unlocked")
-            except FileNotFoundError:
-                self._set_unlocked(False)
-                self.query_one("#status", Static).update("no vault meme found. create it first")
-            except InvalidTag:
-                self._set_unlocked(False)
-                self.query_one("#status", Static).update("wrong master password")
-            except Exception as e:
-                self._set_unlocked(False)
-                self.query_one("#status", Static).update(str(e))
-            return
-
-        if not self.unlocked:
-            self.query_one("#status", Static).update("unlock first")
+            self._set_unlocked(False)
+            self.start_task("unlock", session.unlock, master, label="unlocking…")
             return
 
-        if event.button.id == "go-store":
-            self.app.push_screen(StoreScreen(master))
-        elif event.button.id == "go-get":
-            self.app.push_screen(GetScreen(master))
+    def create_vault(self, master: str, mode: str) -> None:
+        session = self.app.session
+        cover_path = session.paths.dir / "cover.png"
+        # a prefetched cover makes this instant, otherwise download one now
+        if self.app.covers.take(cover_path) is None:
+            self.report("create", "downloading meme…")
+            try:
+                self.app.covers.fetcher.fetch(cover_path)
+            except Exception as e:
+                prefetch = self.app.covers.error
+                if prefetch is not None and str(prefetch) != str(e):
+                    raise RuntimeError(f"failed to fetch meme: {e} (prefetch failed too: {prefetch})") from e
+                raise RuntimeError(f"failed to fetch meme: {e}") from e
+
+        self.report("create", "deriving key and writing vault…")
+        session.create(master, cover_path, mode)
+
+    def on_task_done(self, message: TaskDone) -> None:
+        status = self.query_one("#status", Static)
+
+        if message.task == "probe":
+            if message.error is not None:
+                self.probed = True
+                self.query_one("#unlock", Button).disabled = False
+                status.update(f"error: {message.error}")
+                self.preview_done()
+                return
+            self.probe_done(*message.result)
+
+        elif message.task == "preview":
+            meme_view = self.query_one("#meme-view", Static)
+            if message.error is not None:
+                meme_view.update(str(message.error))
+            else:
+                meme_view.update(message.result)
+            self.preview_done()
+
+        elif message.task == "fold":
+            # the entries are safe in the journal, the next unlock picks them up
+            if message.error is not None:
+                status.update(f"vault locked, journal not folded back: {message.error}")
+
+        elif message.task == "create":
+            if message.error:
+                status.update(str(message.error))
+                return
+            self._set_unlocked(False)
+            status.update("vault meme created at ~/.vaultic/vault.png")
+            self.query_one("#create-vault", Button).disabled = True
+            self.query_one("#pixel-mode", Checkbox).display = False
+            self.update_preview()
+
+        elif message.task == "unlock":
+            if message.error is None:
+                self._set_unlocked(True)
+                status.update("unlocked")
+                return
+            from cryptography.exceptions import InvalidTag
+            self.app.session.lock()
+            self._set_unlocked(False)
+            if isinstance(message.error, FileNotFoundError):
+                status.update("no vault meme found. create it first")
+            elif isinstance(message.error, InvalidTag):
+                status.update("wrong master password")
+            else:
+                status.update(str(message.error))
 
 
-class StoreScreen(Screen):
-    def __init__(self, master: str) -> None:
-        super().__init__()
-        self.master = master
+class StoreScreen(TaskScreen):
 
     def compose(self):
         with Container(id="panel"):
@@ -179,21 +362,8 @@ class StoreScreen(Screen):
             yield Button("back", id="back", classes="buttons")
             yield Static("", id="status", classes="box")
 
-    def gen_pwd(self, length: int) -> str:
-        alphabet = string.ascii_letters + string.digits + "!@#$%^&*()-_=+[]{};:,.?/"
-        length = max(8, min(length, 64))
-
-        picks = [
-            secrets.choice(string.ascii_lowercase),
-            secrets.choice(string.ascii_uppercase),
-            secrets.choice(string.digits),
-            secrets.choice("!@#$%^&*()-_=+[]{};:,.?/"),
-        ]
-        for i in range(length - len(picks)):
-            letter = secrets.choice(alphabet)
-            picks.append(letter)
-        secrets.SystemRandom().shuffle(picks)
-        return "".join(picks)
+    def gen_pwd(self, length: int) -> Generated:
+        return passwords(Policy(length=max(8, min(length, MAX_LENGTH))))[0]
 
     def on_button_pressed(self, event: Button.Pressed) -> None:
         if event.button.id == "back":
@@ -211,8 +381,8 @@ class StoreScreen(Screen):
                 self.query_one("#status", Static).update("length must be a number")
                 return
             pw = self.gen_pwd(length)
-            self.query_one("#password", Input).value = pw
-            self.query_one("#status", Static).update(f"generated {len(pw)}-char password")
+            self.query_one("#password", Input).value = pw.password
+            self.query_one("#status", Static).update(f"generated {len(pw.password)}-char password, {pw.bits:.0f} bits")
             
             return
 
@@ -222,6 +392,7 @@ class StoreScreen(Screen):
                 self.query_one("#status", Static).update("nothing to copy")
                 return
             try:
+                import pyperclip
                 pyperclip.copy(pw)
                 self.query_one("#status", Static).update("copied password to clipboard")
             except Exception as e:
@@ -236,31 +407,42 @@ class StoreScreen(Screen):
                 self.query_one("#status", Static).update("fill service + password")
                 return
 
-            try:
-                v = Vault(self.master)
-                v.add_entry(service, password)
-                self.query_one("#status", Static).update(
-                    f"stored password for {service.strip().lower()}"
-                )
-            except FileNotFoundError:
-                self.query_one("#status", Static).update("create vault meme first")
-            except InvalidTag:
-                self.query_one("#status", Static).update("wrong master password")
-            except Exception as e:
-                self.query_one("#status", Static).update(f"error: {e}")
+            self.start_task("save", self.save_entry, service, password, label="saving…")
+
+    def save_entry(self, service: str, password: str) -> str:
+        self.app.session.vault().add_entry(service, password)
+        return service.strip().lower()
 
+    def on_task_done(self, message: TaskDone) -> None:
+        if message.task == "save":
+            if message.error:
+                self.show_error(message.error)
+                return
+            if self.app.services is not None:
+                self.app.services.add(message.result)
+            self.query_one("#status", Static).update(f"stored password for {message.result}")
 
-class GetScreen(Screen):
-    def __init__(self, master: str) -> None:
+
+class GetScreen(TaskScreen):
+    def __init__(self) -> None:
         super().__init__()
-        self.master = master
         self.sel_service: str | None = None
+        # what the option list holds, so a keystroke that doesn't change the
+        # results doesn't rebuild it
+        self.shown: list[str] | None = None
+        self._search_timer = None
+        # earlier passwords of sel_service once confirmed, cycled through
+        # by "previous" until they are hidden again
+        self.versions: list | None = None
+        self.version_pos = -1
 
     def compose(self):
         with Container(id="panel"):
             yield Static("retrieve password", id="title")
             yield Static("saved services:", id="service_subtitle")
-            yield ListView(id="services")
+            yield Input(placeholder="search services", id="search")
+            # option lists only render the visible lines, no widget per service
+            yield OptionList(id="services")
 
             with Vertical():
                 yield Button("refresh list", id="refresh", classes="buttons")
@@ -270,6 +452,7 @@ class GetScreen(Screen):
 
             with Horizontal(id="reveal-row"):
                 yield Button("reveal", id="reveal", classes="buttons")
+                yield Button("previous", id="previous", classes="buttons")
                 yield Button("copy", id="copy-get", classes="buttons")
                 yield Button("update", id="update", classes="buttons")
                 yield Button("delete", id="delete", classes="buttons")
@@ -281,45 +464,86 @@ class GetScreen(Screen):
             yield Button("back", id="back", classes="buttons")
             yield Static("", id="status", classes="box")
     
-    def on_mount(self):
-        self.refresh_services()
-
     def refresh_services(self) -> None:
-        list_view = self.query_one("#services", ListView)
-        list_view.clear()
+        self.start_task("refresh", lambda: load_services(self.app.session.vault()), label="loading services…")
 
-        try:
-            v = Vault(self.master)
-            services = v.list_services()
-
-            if not services:
-                item = ListItem(Static("no saved services"))
-                item.service = None
-                list_view.append(item)
-                self.query_one("#status", Static).update("no saved services")
-                return
+    def show_services(self, index: ServiceIndex) -> None:
+        self.app.services = index
+        self.show_results()
+
+        if not len(index):
+            self.query_one("#status", Static).update("no saved services")
+            return
 
-            for s in services:
-                item = ListItem(Static(s))
-                item.service = s
-                list_view.append(item)
+        self.query_one("#status", Static).update("select a service")
 
-            self.query_one("#status", Static).update("select a service")
-        except FileNotFoundError:
-            self.query_one("#status", Static).update("create vault meme first")
-        except InvalidTag:
-            self.query_one("#status", Static).update("wrong master password (or vault modified)")
-        except Exception as e:
-            self.query_one("#status", Static).update(str(e))
-    
-    def on_resume(self):
-        self.refresh_services()
+    # one more result than fits tells whether there are more
+    def show_results(self) -> None:
+        index = self.app.services
+        if index is None:
+            return
+        query = self.query_one("#search", Input).value
+        results = index.search(query)
+        if results and results == self.shown:
+            return
+        self.shown = results
 
-    def on_list_view_selected(self, event: ListView.Selected) -> None:
-        self.sel_service = getattr(event.item, "service", None)
-        self.query_one("#password_out", Input).value = ""
+        option_list = self.query_one("#services", OptionList)
+        option_list.clear_options()
+
+        if not len(index):
+            option_list.add_option(Option("no saved services", disabled=True))
+            return
+
+        if not results:
+            option_list.add_option(Option(f"nothing matches {query.strip()!r}", disabled=True))
+            return
+        # every match, the list only renders the rows on screen
+        option_list.add_options(Option(s, id=s) for s in results)
+
+    def on_input_changed(self, event: Input.Changed) -> None:
+        if event.input.id == "search":
+            if self._search_timer is not None:
+                self._search_timer.stop()
+            self._search_timer = self.set_timer(SEARCH_DEBOUNCE, self.show_results)
+
+    # the app keeps the index between visits, only the first one (or the first
+    # after a lock) loads it
+    def on_screen_resume(self):
+        if self.app.services is None:
+            self.refresh_services()
+        else:
+            self.show_results()
+
+    # a refresh still running when another screen is pushed is stale anyway
+    def on_screen_suspend(self):
+        self.cancel_task("refresh")
+        self.hide_password()
+        self.query_one("#confirm", Input).value = ""
+
+    def on_option_list_option_selected(self, event: OptionList.OptionSelected) -> None:
+        self.sel_service = event.option.id
+        self.hide_password()
         self.query_one("#status", Static).update(f"selected: {self.sel_service}")
 
+    def hide_password(self) -> None:
+        self.query_one("#password_out", Input).value = ""
+        self.versions = None
+        self.version_pos = -1
+
+    # each press shows the next older password, wrapping around
+    def show_previous(self) -> None:
+        status = self.query_one("#status", Static)
+        if not self.versions:
+            status.update("no earlier passwords")
+            return
+        self.version_pos = (self.version_pos + 1) % len(self.versions)
+        version = self.versions[self.version_pos]
+        self.query_one("#password_out", Input).value = version["password"]
+        replaced = time.strftime("%Y-%m-%d %H:%M", time.localtime(version["replaced"]))
+        status.update(f"previous {self.version_pos + 1} of {len(self.versions)}, replaced {replaced} (will hide after 15 seconds)")
+        self.set_timer(15, self.hide_password)
+
     def on_button_pressed(self, event: Button.Pressed) -> None:
         if event.button.id == "back":
             self.app.pop_screen()
@@ -335,6 +559,7 @@ class GetScreen(Screen):
                 self.query_one("#status", Static).update("nothing to copy (reveal first)")
                 return
             try:
+                import pyperclip
                 pyperclip.copy(pw)
                 self.query_one("#status", Static).update("copied to clipboard")
             except Exception as e:
@@ -351,62 +576,101 @@ class GetScreen(Screen):
                 self.query_one("#status", Static).update("enter master password to reveal")
                 return
 
-            try:
-                v = Vault(master_confirm)
-                entry = v.get_entry(self.sel_service)
+            self.start_task("reveal", self.confirmed, master_confirm, lambda v, s: v.get_entry(s), self.sel_service, label="checking master password…")
+            return
 
-                if not entry:
-                    self.query_one("#status", Static).update("no entry found")
-                    return
+        if event.button.id == "previous":
+            if not self.sel_service:
+                self.query_one("#status", Static).update("select a service first")
+                return
+            if self.versions is not None:
+                self.show_previous()
+                return
 
-                self.query_one("#password_out", Input).value = entry["password"]
-                self.query_one("#status", Static).update("revealed (will hide after 15 seconds)")
-                self.set_timer(15, lambda: setattr(self.query_one("#password_out", Input), "value", ""))
+            master_confirm = self.query_one("#confirm", Input).value
+            if not master_confirm:
+                self.query_one("#status", Static).update("enter master password to reveal")
                 return
 
-            except FileNotFoundError:
-                self.query_one("#status", Static).update("create vault meme first")
-            except InvalidTag:
-                self.query_one("#status", Static).update("wrong master password")
-            except Exception as e:
-                self.query_one("#status", Static).update(f"error: {e}")
+            self.start_task("previous", self.confirmed, master_confirm, lambda v, s: (s, v.history(s)), self.sel_service, label="checking master password…")
+            return
 
         if event.button.id == "delete":
             if not self.sel_service:
                 self.query_one("#status", Static).update("please select a service to delete")
+                return
 
             master_confirm = self.query_one("#confirm", Input).value
             if not master_confirm:
                 self.query_one("#status", Static).update("please enter the master password to delete the service")
+                return
 
-            try:
-                v = Vault(master_confirm)
-                deleted = v.delete_entry(self.sel_service)
-                deleted_name = self.sel_service
-                if deleted:
-                    self.sel_service = None
-                    self.query_one("#status", Static).update(f"deleted password for {deleted_name}!")
-                    self.query_one("#password_out", Input).value = ""
-                    self.refresh_services()
-                else:
-                    self.query_one("#status", Static).update("service not found")
-            except InvalidTag:
-                self.query_one("#status", Static).update("wrong master password")
-            except Exception as e:
-                print(e)
+            service = self.sel_service
+            self.start_task("delete", self.confirmed, master_confirm, lambda v, s: (s, v.delete_entry(s)), service, label="deleting…")
+            return
 
         if event.button.id == "update":
             if not self.sel_service:
                 self.query_one("#status", Static).update("select a service first")
                 return
-            self.app.push_screen(UpdateScreen(self.sel_service))
+            self.app.push_screen(UpdateScreen(self.sel_service), self.updated)
             return
 
+    # what UpdateScreen did, None when it was left with back
+    def updated(self, done: str | None) -> None:
+        if done:
+            self.query_one("#status", Static).update(done)
+
+    def on_task_done(self, message: TaskDone) -> None:
+        status = self.query_one("#status", Static)
+
+        if message.error:
+            if message.task == "refresh":
+                self.show_error(message.error, "wrong master password (or vault modified)")
+            else:
+                self.show_error(message.error)
+            return
+
+        if message.task == "refresh":
+            self.show_services(message.result)
+
+        elif message.task == "reveal":
+            entry = message.result
+            if not entry:
+                status.update("no entry found")
+                return
+            self.query_one("#password_out", Input).value = entry["password"]
+            status.update("revealed (will hide after 15 seconds)")
+            self.set_timer(15, lambda: setattr(self.query_one("#password_out", Input), "value", ""))
+
+        elif message.task == "previous":
+            service, versions = message.result
+            if service != self.sel_service:
+                return
+            self.versions = versions
+            self.version_pos = -1
+            self.show_previous()
+
+        elif message.task == "delete":
+            deleted_name, deleted = message.result
+            if deleted:
+                if self.sel_service == deleted_name:
+                    self.sel_service = None
+                status.update(f"deleted password for {deleted_name}!")
+                self.query_one("#password_out", Input).value = ""
+                if self.app.services is not None:
+                    self.app.services.remove(deleted_name)
+                self.show_results()
+            else:
+                status.update("service not found")
+
 
-class UpdateScreen(Screen):
+class UpdateScreen(TaskScreen):
     def __init__(self, service: str):
         super().__init__()
         self.service = service
+        self.versions: list | None = None
+        self.version_pos = -1
 
     def compose(self):
         with Container(id="panel"):
@@ -416,6 +680,9 @@ class UpdateScreen(Screen):
             current = Input(placeholder="(reveal to load)", id="current_pwd", disabled=True)
             yield current
 
+            yield Static("previous password:", id="previous_label")
+            yield Input(placeholder="(previous to load)", id="previous_pwd", disabled=True)
+
             yield Static("new password:", id="new")
             yield Input(placeholder="enter new password", id="new_pwd", password=True)
            
@@ -426,30 +693,52 @@ class UpdateScreen(Screen):
                 yield Button("update", id="update", classes="buttons")
                 yield Button("back", id="back", classes="buttons")
                 yield Button("reveal", id="reveal", classes="buttons")
+                yield Button("previous", id="previous", classes="buttons")
+                yield Button("restore", id="restore", classes="buttons")
             
             yield Static("", id="status", classes="box")
 
     def on_mount(self):
         self.query_one("#current_pwd", Input).value = ""
 
+    def show_previous(self) -> None:
+        if not self.versions:
+            self.query_one("#status", Static).update("no earlier passwords")
+            return
+        self.version_pos = (self.version_pos + 1) % len(self.versions)
+        version = self.versions[self.version_pos]
+        self.query_one("#previous_pwd", Input).value = version["password"]
+        replaced = time.strftime("%Y-%m-%d %H:%M", time.localtime(version["replaced"]))
+        self.query_one("#status", Static).update(f"previous {self.version_pos + 1} of {len(self.versions)}, replaced {replaced}")
+
     def on_button_pressed(self, event: Button.Pressed):
         if event.button.id == "reveal":
             master_confirm = self.query_one("#confirm", Input).value
             if not master_confirm:
                 self.query_one("#status", Static).update("enter your master password first")
                 return
-            try:
-                v = Vault(master_confirm)
-                entry = v.get_entry(self.service)
-                if not entry:
-                    self.query_one("#status", Static).update("entry not found")
-                    return
-                self.query_one("#current_pwd", Input).value = entry["password"]
-                self.query_one("#status", Static).update("current password revealed")
-            except InvalidTag:
-                self.query_one("#status", Static).update("wrong master password")
-            except Exception as e:
-                print(e)
+            self.start_task("reveal", self.confirmed, master_confirm, lambda v, s: v.get_entry(s), self.service, label="checking master password…")
+            return
+
+        if event.button.id == "previous":
+            if self.versions is not None:
+                self.show_previous()
+                return
+            master_confirm = self.query_one("#confirm", Input).value
+            if not master_confirm:
+                self.query_one("#status", Static).update("enter your master password first")
+                return
+            self.start_task("previous", self.confirmed, master_confirm, lambda v, s: v.history(s), self.service, label="checking master password…")
+            return
+
+        # brings back the previous password on show, the latest one if none is
+        if event.button.id == "restore":
+            master_confirm = self.query_one("#confirm", Input).value
+            if not master_confirm:
+                self.query_one("#status", Static).update("enter your master password first")
+                return
+            n = max(self.version_pos, 0)
+            self.start_task("restore", self.confirmed, master_confirm, lambda v, s, i: v.restore(s, i), self.service, n, label="restoring…")
             return
 
         if event.button.id == "back":
@@ -466,14 +755,142 @@ class UpdateScreen(Screen):
             if not master_confirm:
                 self.query_one("#status", Static).update("enter your master password")
                 return
-            
-            try:
-                v = Vault(master_confirm)
-                v.update_entry(self.service, new_pw)
-                self.query_one("#status", Static).update(f"updated password for {self.service}")
 
-                self.app.pop_screen()
-            except InvalidTag:
-                self.query_one("#status", Static).update("wrong master password")
-            except Exception as e:
-                print(e)
\ No newline at end of file
+            self.start_task("update", self.confirmed, master_confirm, lambda v, s, p: v.update_entry(s, p), self.service, new_pw, label="updating…")
+
+    def on_task_done(self, message: TaskDone) -> None:
+        if message.error:
+            self.show_error(message.error)
+            return
+
+        if message.task == "reveal":
+            entry = message.result
+            if not entry:
+                self.query_one("#status", Static).update("entry not found")
+                return
+            self.query_one("#current_pwd", Input).value = entry["password"]
+            self.query_one("#status", Static).update("current password revealed")
+
+        # the get screen shows what was done, this one closes right away
+        elif message.task == "update":
+            self.dismiss(f"updated password for {self.service}")
+
+        elif message.task == "previous":
+            self.versions = message.result
+            self.version_pos = -1
+            self.show_previous()
+
+        elif message.task == "restore":
+            if not message.result:
+                self.query_one("#status", Static).update("no earlier password to restore")
+                return
+            self.dismiss(f"restored an earlier password for {self.service}")
+
+
+class ImportScreen(TaskScreen):
+    def compose(self):
+        with Container(id="panel"):
+            yield Static("import passwords", id="title")
+            yield Static("csv (chrome, firefox, bitwarden, 1password), bitwarden json or keepass xml export:", id="import_subtitle")
+            yield Input(placeholder="path to export file", id="import_path")
+            yield ProgressBar(id="import_progress", show_eta=False)
+
+            with Horizontal(id="import-buttons"):
+                yield Button("import", id="import", classes="buttons")
+                yield Button("back", id="back", classes="buttons")
+
+            yield Static("", id="status", classes="box")
+
+    def on_button_pressed(self, event: Button.Pressed) -> None:
+        if event.button.id == "back":
+            self.app.pop_screen()
+            return
+
+        if event.button.id == "import":
+            raw = self.query_one("#import_path", Input).value.strip()
+            if not raw:
+                self.query_one("#status", Static).update("enter the path of an export file")
+                return
+            path = Path(raw).expanduser()
+            if not path.is_file():
+                self.query_one("#status", Static).update(f"no file at {path}")
+                return
+            self.query_one("#import", Button).disabled = True
+            self.query_one("#import_progress", ProgressBar).update(total=None, progress=0)
+            self.start_task("import", self.run_import, path, label="importing…")
+
+    # a large import would stall the loop merging its names into the app's
+    # index, so the worker rebuilds it instead
+    def run_import(self, path: Path):
+        from .importer import import_file
+        progress = lambda done, read, total: self.report("import", f"importing… {done} rows read", read, total)
+        vault = self.app.session.vault()
+        result = import_file(vault, path, progress=progress)
+        self.report("import", "indexing services…")
+        return result, load_services(vault)
+
+    # the status text is set by TaskScreen.on_task_progress as well
+    def on_task_progress(self, message: TaskProgress) -> None:
+        if message.total is not None:
+            self.query_one("#import_progress", ProgressBar).update(total=max(message.total, 1), progress=message.done)
+
+    def on_task_done(self, message: TaskDone) -> None:
+        self.query_one("#import", Button).disabled = False
+        if message.error:
+            from cryptography.exceptions import InvalidTag
+            from .session import SessionLocked
+            if isinstance(message.error, (SessionLocked, InvalidTag, FileNotFoundError)):
+                self.show_error(message.error, "wrong master password (or vault modified)")
+            else:
+                self.query_one("#status", Static).update(f"import failed: {message.error}")
+            return
+        result, self.app.services = message.result
+        text = f"imported {result.imported} passwords"
+        if result.skipped:
+            text += f", skipped {result.skipped} rows without a name or password"
+        self.query_one("#status", Static).update(text)
+
+
+# per stage latencies from the tracer ring buffer, toggled from the app
+class TraceScreen(ModalScreen):
+    BINDINGS = [("escape", "app.toggle_trace", "close"), ("ctrl+t", "app.toggle_trace", "close")]
+
+    def compose(self):
+        with Container(id="trace-panel"):
+            yield Static("timings (ctrl+t to close, c to clear)", id="trace-title")
+            yield Static("", id="trace-table")
+
+    def on_mount(self):
+        self.render_stats()
+        self.set_interval(0.5, self.render_stats)
+
+    def key_c(self) -> None:
+        tracer.clear()
+        self.render_stats()
+
+    def render_stats(self) -> None:
+        stats = tracer.stats()
+        if not stats:
+            self.query_one("#trace-table", Static).update("no spans recorded yet, use the vault and they show up here")
+            return
+        edges = " ".join(f"<{e:g}" for e in BUCKETS_MS) + " ms"
+        table = Table(expand=True, box=None)
+        table.add_column("stage")
+        table.add_column("n", justify="right")
+        table.add_column("last ms", justify="right")
+        table.add_column("p50", justify="right")
+        table.add_column("p95", justify="right")
+        table.add_column("max", justify="right")
+        table.add_column(f"histogram ({edges})")
+        for name, s in sorted(stats.items(), key=lambda kv: -kv[1]["p50"]):
+            table.add_row(
+                name,
+                str(s["count"]),
+                f"{s['last']:.3f}",
+                f"{s['p50']:.3f}",
+                f"{s['p95']:.3f}",
+                f"{s['max']:.3f}",
+                sparkline(s["histogram"]),
+            )
+        self.query_one("#trace-table", Static).update(table)
+
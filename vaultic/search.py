@@ -0,0 +1,131 @@
+from __future__ import annotations
+from bisect import bisect_left, insort
+from itertools import islice
+from typing import Dict, Iterable, List, Optional, Set
+
+MIN_FUZZY_SCORE = 0.3
+# sorts after every other character, closes a prefix range
+PREFIX_END = "\U0010ffff"
+
+
+def trigrams(text: str) -> Set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# in memory index over service names: a sorted name array answers prefix
+# queries with two bisects, a trigram table (built on the first fuzzy query)
+# ranks the rest, both are updated one name at a time
+class ServiceIndex:
+
+    def __init__(self, names: Iterable[str] = ()):
+        self.rebuild(names)
+
+    def rebuild(self, names: Iterable[str]) -> None:
+        self._sorted: List[str] = sorted(set(names))
+        self._grams: Optional[Dict[str, Set[str]]] = None
+
+    def __len__(self) -> int:
+        return len(self._sorted)
+
+    def __contains__(self, name: str) -> bool:
+        i = bisect_left(self._sorted, name)
+        return i < len(self._sorted) and self._sorted[i] == name
+
+    def _index_grams(self, name: str) -> None:
+        for gram in trigrams(name):
+            self._grams.setdefault(gram, set()).add(name)
+
+    def add(self, name: str) -> None:
+        if name in self:
+            return
+        insort(self._sorted, name)
+        if self._grams is not None:
+            self._index_grams(name)
+
+    def remove(self, name: str) -> None:
+        if name not in self:
+            return
+        del self._sorted[bisect_left(self._sorted, name)]
+        if self._grams is not None:
+            for gram in trigrams(name):
+                bucket = self._grams.get(gram)
+                if bucket is not None:
+                    bucket.discard(name)
+                    if not bucket:
+                        del self._grams[gram]
+
+    def names(self) -> List[str]:
+        return list(self._sorted)
+
+    def prefixed(self, prefix: str) -> List[str]:
+        lo = bisect_left(self._sorted, prefix)
+        hi = bisect_left(self._sorted, prefix + PREFIX_END, lo)
+        return self._sorted[lo:hi]
+
+    # builds the trigram table now, from a worker, so the first fuzzy query
+    # typed doesn't pay for it
+    def warm(self) -> None:
+        self._gram_table()
+
+    def _gram_table(self) -> Dict[str, Set[str]]:
+        if self._grams is None:
+            self._grams = {}
+            for name in self._sorted:
+                self._index_grams(name)
+        return self._grams
+
+    # names holding every trigram of the query, checked for the real substring,
+    # the first limit of them in order. with more candidates than that, walking
+    # the sorted names until enough turn up beats sorting all of them
+    def _containing(self, query: str, limit: Optional[int] = None) -> List[str]:
+        grams = self._gram_table()
+        buckets = sorted((grams.get(query[i:i + 3], set()) for i in range(len(query) - 2)), key=len)
+        found = set.intersection(*buckets) if buckets else set()
+        if limit is not None and len(found) > limit:
+            matches = (name for name in self._sorted if name in found and query in name)
+            return list(islice(matches, limit))
+        return sorted(name for name in found if query in name)
+
+    def _fuzzy(self, query: str, skip: Set[str]) -> List[str]:
+        grams = self._gram_table()
+        wanted = trigrams(query)
+        counts: Dict[str, int] = {}
+        for gram in wanted:
+            for name in grams.get(gram, ()):
+                counts[name] = counts.get(name, 0) + 1
+        scored = [
+            (-shared / len(wanted), len(name), name)
+            for name, shared in counts.items()
+            if name not in skip and shared / len(wanted) >= MIN_FUZZY_SCORE
+        ]
+        scored.sort()
+        return [name for _, _, name in scored]
+
+    # prefix matches first, then names containing the query, then fuzzy
+    # trigram matches (queries of 3+ characters) ranked by overlap
+    def search(self, query: str, limit: Optional[int] = None) -> List[str]:
+        query = query.strip().lower()
+        if not query:
+            return self._sorted[:limit]
+
+        results = self.prefixed(query)
+        if limit is not None and len(results) >= limit:
+            return results[:limit]
+
+        if len(query) < 3:
+            # too short for trigrams, a scan over the names is still quick
+            rest = (name for name in self._sorted if query in name and not name.startswith(query))
+            results += islice(rest, None if limit is None else limit - len(results))
+            return results
+
+        seen = set(results)
+
+        for name in self._containing(query, limit):
+            if name not in seen:
+                results.append(name)
+                seen.add(name)
+        # fuzzy ranking is the costly part, skip it once the limit is met
+        if limit is None or len(results) < limit:
+            results.extend(self._fuzzy(query, seen))
+        return results[:limit]
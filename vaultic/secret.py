@@ -0,0 +1,62 @@
+from __future__ import annotations
+import threading
+from typing import Optional, Union
+
+# the derived key and every decrypted or to be sealed plaintext sit in
+# bytearrays that are zeroed as soon as they are done with. python strs can't
+# be wiped, so the json text, service names and passwords handed to callers
+# stay behind until collected: this narrows where secrets linger, it can't
+# promise they are gone
+
+# a thread's scratch buffer starts this big and grows to the largest
+# plaintext it has held
+SCRATCH_BYTES = 4096
+
+Buffer = Union[bytearray, memoryview]
+
+_local = threading.local()
+_libc = None
+
+
+# zero buf in place, bytes can't be and are left alone
+def wipe(buf: Optional[Buffer]) -> None:
+    if buf is not None and not isinstance(buf, bytes):
+        buf[:] = bytes(len(buf))
+
+
+# size writable bytes of this thread's reusable buffer, the caller wipes them
+# once done. not reentrant: whatever is decoded out of it has to be copied
+# before the next call on the same thread. a plain function rather than a
+# context manager, unseal() runs once per record and that overhead showed
+def scratch(size: int) -> memoryview:
+    buf = getattr(_local, "buf", None)
+    if buf is None or len(buf) < size:
+        buf = _local.buf = bytearray(max(size, SCRATCH_BYTES))
+    return memoryview(buf)[:size]
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        import ctypes
+        try:
+            _libc = ctypes.CDLL(None, use_errno=True)
+        except (OSError, TypeError):
+            # windows has no process-wide symbol table to look mlock up in
+            _libc = False
+    return _libc or None
+
+
+# keeps the pages under buf out of swap, best effort: False where mlock is
+# missing or RLIMIT_MEMLOCK (often 64 KiB) is used up. a key fits in one
+# page. never undone, other small objects and later keys share those pages
+def lock_memory(buf: bytearray) -> bool:
+    libc = _load_libc()
+    if libc is None or not hasattr(libc, "mlock") or not buf:
+        return False
+    import ctypes
+    view = (ctypes.c_char * len(buf)).from_buffer(buf)
+    try:
+        return libc.mlock(ctypes.c_void_p(ctypes.addressof(view)), ctypes.c_size_t(len(buf))) == 0
+    finally:
+        del view
@@ -0,0 +1,339 @@
+import hmac
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator, Optional, Tuple
+from cryptography.exceptions import InvalidTag
+from . import journal
+from .kdf import KdfParams, calibrate, derive_key, parse_salt
+from .secret import wipe
+from .vault import CHUNK_MODE, StateCache, Vault, VaultPaths, default, pending_salt
+
+DEFAULT_IDLE_TIMEOUT = 300.0
+
+
+class SessionLocked(Exception):
+    pass
+
+
+# the session's key and how many vault operations are using it. every Vault
+# the session hands out shares the one bytearray, so forget() only zeroes it
+# once the last of them is done: a batch running when the vault locks still
+# commits under the whole key, and new operations are refused. use() nests,
+# only the outermost one on each thread counts
+class KeyHold:
+
+    def __init__(self, key: bytearray):
+        self.key = key
+        self._users = 0
+        self._forgotten = False
+        self._lock = threading.Lock()
+        self._depth = threading.local()
+
+    @contextmanager
+    def use(self) -> Iterator[None]:
+        depth = getattr(self._depth, "n", 0)
+        if depth:
+            self._depth.n = depth + 1
+            try:
+                yield
+            finally:
+                self._depth.n = depth
+            return
+        with self._lock:
+            if self._forgotten:
+                raise SessionLocked("vault is locked")
+            self._users += 1
+        self._depth.n = 1
+        try:
+            yield
+        finally:
+            self._depth.n = 0
+            with self._lock:
+                self._users -= 1
+                last = self._forgotten and not self._users
+            if last:
+                wipe(self.key)
+
+    def forget(self) -> None:
+        with self._lock:
+            self._forgotten = True
+            idle = not self._users
+        if idle:
+            wipe(self.key)
+
+
+def idle_timeout_from_env() -> float:
+    raw = os.environ.get("VAULTIC_IDLE_TIMEOUT", "").strip()
+    try:
+        return float(raw) if raw else DEFAULT_IDLE_TIMEOUT
+    except ValueError:
+        return DEFAULT_IDLE_TIMEOUT
+
+
+# unlocked vault shared by every screen, scrypt runs once at unlock and the
+# derived key is kept until the idle timeout passes or lock() is called, which
+# zeroes it once running operations finish (see KeyHold): Vaults handed out
+# before that can't decrypt anymore. locking
+# never compacts itself, it leaves a copy of the key behind for fold() which
+# callers run off their event loop. with use_agent, a running `vaultic agent`
+# holds the key instead and vault() hands out a RemoteVault talking to it
+class VaultSession:
+
+    def __init__(self, paths: Optional[VaultPaths] = None, idle_timeout: Optional[float] = None, use_agent: bool = False):
+        self.paths = paths or default()
+        self.idle_timeout = idle_timeout_from_env() if idle_timeout is None else idle_timeout
+        self.use_agent = use_agent
+        self._key: Optional[bytes] = None
+        self._hold: Optional[KeyHold] = None
+        self._kdf: Optional[KdfParams] = None
+        self._agent = None
+        # key copy a pending journal still has to be folded back with
+        self._owed: Optional[Tuple[bytearray, KdfParams]] = None
+        # see protect_keys(), key_locked is what it said for the current key
+        self._protect: Optional[Callable[[bytearray], bool]] = None
+        self.key_locked = False
+        # decrypted index shared by every Vault handed out, see StateCache
+        self._cache = StateCache()
+        self._last_used = 0.0
+        self._lock = threading.Lock()
+
+    # only create() writes salt.bin, after calibrating for this machine
+    def _derive(self, master_key: str) -> tuple[bytes, KdfParams]:
+        if not self.paths.salt_file.exists():
+            raise FileNotFoundError(f"no vault at {self.paths.vault_file}, create one first")
+        salt, kdf = parse_salt(self.paths.salt_file.read_bytes())
+        return derive_key(master_key, salt, kdf), kdf
+
+    # a key already kept (unlocking twice) is let go like on lock, vaults
+    # still using it finish first
+    def _keep(self, key: bytearray, kdf: KdfParams) -> None:
+        if self._hold is not None and self._hold.key is not key:
+            self._hold.forget()
+        self._key = key
+        self._hold = KeyHold(key)
+        self._kdf = kdf
+        self.key_locked = self._protect is not None and self._protect(key)
+
+    # fn (the agent's mlock) is applied to the current key and every key
+    # kept after it, including copies left for fold()
+    def protect_keys(self, fn: Callable[[bytearray], bool]) -> None:
+        with self._lock:
+            self._protect = fn
+            if self._key is not None:
+                self.key_locked = fn(self._key)
+
+    def _expired(self) -> bool:
+        if self.idle_timeout <= 0:
+            return False
+        return time.monotonic() - self._last_used > self.idle_timeout
+
+    @property
+    def unlocked(self) -> bool:
+        with self._lock:
+            return (self._key is not None or self._agent is not None) and not self._expired()
+
+    def idle_for(self) -> float:
+        return time.monotonic() - self._last_used
+
+    def touch(self) -> None:
+        self._last_used = time.monotonic()
+
+    def _connect_agent(self):
+        if not self.use_agent:
+            return None
+        from .remote import connect, socket_path
+        return connect(socket_path(self.paths))
+
+    # an agent that is already unlocked needs no master password at all
+    def attach_agent(self) -> bool:
+        client = self._connect_agent()
+        if client is None:
+            return False
+        if not client.status()["unlocked"]:
+            client.close()
+            return False
+        with self._lock:
+            self._agent = client
+            self.touch()
+        return True
+
+    # derive once, check it against the vault and keep it, or let the agent
+    # do that when one is running
+    def unlock(self, master_key: str):
+        client = self._connect_agent()
+        if client is not None:
+            from .remote import RemoteVault
+            try:
+                client.request("unlock", master=master_key)
+            except BaseException:
+                client.close()
+                raise
+            with self._lock:
+                self._agent = client
+                self.touch()
+            return RemoteVault(client)
+
+        key, kdf = self._derive(master_key)
+        vault = Vault(paths=self.paths, key=key, kdf=kdf, cache=self._cache)
+        try:
+            vault.verify_master()
+        except (InvalidTag, ValueError):
+            wipe(key)
+            vault = self._finish_rekey(master_key)
+            if vault is None:
+                raise
+        else:
+            # the old salt still opens the vault, any pending one never got used
+            pending_salt(self.paths).unlink(missing_ok=True)
+        with self._lock:
+            self._keep(vault.key, vault.kdf)
+            vault.guard = self._hold.use
+            self.touch()
+        return vault
+
+    # a rekey that died after writing the vault left its salt pending
+    def _finish_rekey(self, master_key: str) -> Optional[Vault]:
+        pending = pending_salt(self.paths)
+        if not pending.exists():
+            return None
+        salt, kdf = parse_salt(pending.read_bytes())
+        vault = Vault(paths=self.paths, key=derive_key(master_key, salt, kdf), kdf=kdf, cache=self._cache)
+        try:
+            vault.verify_master()
+        except (InvalidTag, ValueError):
+            wipe(vault.key)
+            return None
+        os.replace(pending, self.paths.salt_file)
+        return vault
+
+    # new vaults get kdf params calibrated for this machine
+    def create(self, master_key: str, cover_path: str | Path, mode: str = CHUNK_MODE, kdf: Optional[KdfParams] = None) -> None:
+        if self.paths.vault_file.exists():
+            raise FileExistsError(f"vault already exists at {self.paths.vault_file}")
+        # a salt.bin without a vault opens nothing, older versions left one
+        # behind when unlock was clicked before a vault existed
+        self.paths.salt_file.unlink(missing_ok=True)
+        vault = Vault(master_key, paths=self.paths, kdf=kdf or calibrate())
+        try:
+            vault.create_meme(cover_path, mode)
+        finally:
+            wipe(vault.key)
+
+    # re-seal under new params and/or a new master, the session keeps the new
+    # key. always done locally, a running agent is locked since its key is stale
+    def rekey(self, master_key: str, new_master: Optional[str] = None, kdf: Optional[KdfParams] = None) -> KdfParams:
+        if not self.check(master_key):
+            raise InvalidTag()
+        with self._lock:
+            agent = self._agent
+        if agent is not None:
+            key, current = self._derive(master_key)
+            vault = Vault(paths=self.paths, key=key, kdf=current, cache=self._cache)
+        else:
+            vault = self.vault()
+        old_key = vault.key
+        key = vault.rekey(new_master or master_key, kdf)
+        if agent is not None:
+            agent.request("lock")
+            wipe(old_key)
+        with self._lock:
+            self._forget()
+            self._keep(key, vault.kdf)
+            self.touch()
+        return vault.kdf
+
+    # the image alone should hold every entry once the key is gone, so a
+    # pending journal keeps a copy of the key for fold(). a newer debt
+    # replaces an older one, both cover the same journal
+    def _owe(self) -> None:
+        if self._key is None or not journal.size(self.paths.journal_file):
+            return
+        if self._owed is not None:
+            wipe(self._owed[0])
+        self._owed = bytearray(self._key), self._kdf
+        if self._protect is not None:
+            self._protect(self._owed[0])
+
+    @property
+    def owes_fold(self) -> bool:
+        return self._owed is not None
+
+    # folds the journal left by the last lock or expiry back into the image,
+    # outside the session lock: slow (a whole seal and image write) and meant
+    # for a worker thread. the copied key is wiped whether it worked or not,
+    # errors go to the caller. False when nothing was owed
+    def fold(self) -> bool:
+        with self._lock:
+            owed, self._owed = self._owed, None
+        if owed is None:
+            return False
+        key, kdf = owed
+        try:
+            # its own cache, nothing decrypted outlives the fold
+            return Vault(paths=self.paths, key=key, kdf=kdf).compact()
+        finally:
+            wipe(key)
+
+    # only forgets this session's key or agent connection, the agent itself
+    # keeps running until its own idle timeout or `vaultic agent --stop`
+    def _forget(self) -> None:
+        if self._hold is not None:
+            self._hold.forget()
+        self._key = None
+        self._hold = None
+        self._kdf = None
+        self.key_locked = False
+        self._cache.invalidate()
+        if self._agent is not None:
+            self._agent.close()
+            self._agent = None
+
+    # fold False when the key no longer opens the vault and would fail anyway
+    def lock(self, fold: bool = True) -> None:
+        with self._lock:
+            if fold:
+                self._owe()
+            self._forget()
+            self._last_used = 0.0
+
+    def expire_if_idle(self) -> bool:
+        with self._lock:
+            if (self._key is not None or self._agent is not None) and self._expired():
+                self._owe()
+                self._forget()
+                return True
+        return False
+
+    # touch=False for background work that shouldn't count as activity
+    def vault(self, touch: bool = True):
+        with self._lock:
+            if self._key is None and self._agent is None:
+                raise SessionLocked("vault is locked")
+            if self._expired():
+                self._owe()
+                self._forget()
+                raise SessionLocked("vault locked after inactivity")
+            if touch:
+                self.touch()
+            if self._agent is not None:
+                from .remote import RemoteVault
+                return RemoteVault(self._agent)
+            return Vault(paths=self.paths, key=self._key, kdf=self._kdf, cache=self._cache, guard=self._hold.use)
+
+    # re-run scrypt only when a screen explicitly asks for the master again
+    def check(self, master_key: str) -> bool:
+        with self._lock:
+            key, hold, agent = self._key, self._hold, self._agent
+        if agent is not None:
+            return agent.request("check", master=master_key)
+        if key is None:
+            raise SessionLocked("vault is locked")
+        candidate = self._derive(master_key)[0]
+        try:
+            with hold.use():
+                return hmac.compare_digest(candidate, key)
+        finally:
+            wipe(candidate)
@@ -0,0 +1,56 @@
+from __future__ import annotations
+import hashlib
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+# a sharded vault keeps its entries in several cover images next to
+# vault.png, which then only holds a small sealed manifest naming them. an
+# entry's home shard comes from a stable hash of its service name. shard
+# files are never rewritten in place: every write goes to a new file named
+# after its content and the manifest swap is what publishes it. this module
+# only places entries and names files, sealing lives in vault.py
+
+MAX_SHARDS = 256
+# shard images extracted and decrypted at once on a full read
+SHARD_WORKERS = 8
+
+
+# a shard file named in the manifest is gone or holds something else, a
+# writer replaced it after the manifest was read
+class StaleShard(Exception):
+    pass
+
+
+# jump consistent hash (Lamping and Veach): going from n to n + 1 shards only
+# moves about 1 / (n + 1) of the entries, all of them onto the new shard
+def shard_for(service: str, count: int) -> int:
+    key = int.from_bytes(hashlib.sha256(service.encode("utf-8")).digest()[:8], "big")
+    b, j = -1, 0
+    while j < count:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+def shard_file(vault_file: Path, shard: int, base: bytes) -> str:
+    return f"{vault_file.stem}.shard-{shard:02d}-{base.hex()[:12]}.png"
+
+
+# shard files left by writers that were replaced or died before publishing
+def sweep(vault_file: Path, keep: Iterable[str]) -> int:
+    keep = set(keep)
+    removed = 0
+    for path in vault_file.parent.glob(f"{vault_file.stem}.shard-*.png"):
+        if path.name not in keep:
+            path.unlink(missing_ok=True)
+            removed += 1
+    return removed
+
+
+# entries per shard, for `vaultic shard`
+def sizes(placement: Dict[str, int], count: int) -> List[int]:
+    counts = [0] * count
+    for shard in placement.values():
+        counts[shard] += 1
+    return counts
@@ -0,0 +1,159 @@
+from __future__ import annotations
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+RING_SIZE = 1024
+# upper edges in ms for the debug panel histograms, the last bucket is open
+BUCKETS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500)
+BARS = " ▁▂▃▄▅▆▇█"
+# what `vaultic --profile-startup` watches for, none of it should load
+# before the first frame
+HEAVY_MODULES = ("cryptography", "PIL", "rich_pixels", "numpy", "requests", "pyperclip")
+
+@dataclass
+class Span:
+    name: str
+    start: float
+    duration: float
+    thread: str
+    attrs: Dict = field(default_factory=dict)
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": round(self.duration * 1000, 4),
+            "thread": self.thread,
+            **self.attrs,
+        })
+
+# span recorder behind span()/traced(), spans land in a ring buffer and,
+# when VAULTIC_TRACE=path is set, as newline delimited json in that file
+class Tracer:
+
+    def __init__(self, size: int = RING_SIZE):
+        self.spans: deque[Span] = deque(maxlen=size)
+        self.enabled = False
+        self._out = None
+        self._lock = threading.Lock()
+
+    def enable(self, path: Optional[str] = None) -> None:
+        with self._lock:
+            if path and self._out is None:
+                self._out = open(path, "a", buffering=1, encoding="utf-8")
+            self.enabled = True
+
+    def disable(self) -> None:
+        with self._lock:
+            self.enabled = False
+            if self._out is not None:
+                self._out.close()
+                self._out = None
+
+    def record(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+            if self._out is not None:
+                self._out.write(span.to_json() + "\n")
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        start = time.time()
+        t0 = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            self.record(Span(name, start, time.perf_counter() - t0, threading.current_thread().name, attrs))
+
+    def clear(self) -> None:
+        with self._lock:
+            self.spans.clear()
+
+    def stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            spans = list(self.spans)
+        grouped: Dict[str, List[float]] = {}
+        for s in spans:
+            grouped.setdefault(s.name, []).append(s.duration * 1000)
+        out = {}
+        for name, durations in grouped.items():
+            ordered = sorted(durations)
+            out[name] = {
+                "count": len(durations),
+                "last": durations[-1],
+                "p50": ordered[len(ordered) // 2],
+                "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                "max": ordered[-1],
+                "histogram": histogram(durations),
+            }
+        return out
+
+def histogram(durations_ms: List[float]) -> List[int]:
+    counts = [0] * (len(BUCKETS_MS) + 1)
+    for d in durations_ms:
+        for i, edge in enumerate(BUCKETS_MS):
+            if d < edge:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+    return counts
+
+def sparkline(counts: List[int]) -> str:
+    top = max(counts) or 1
+    return "".join(BARS[0 if c == 0 else max(1, round(c / top * (len(BARS) - 1)))] for c in counts)
+
+# `vaultic --profile-startup`: time since main() at each stage of bringing
+# the tui up, and which heavy modules each stage loaded
+class StartupProfile:
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.marks: List[Tuple[str, float, int, List[str]]] = []
+        self._seen = {m for m in HEAVY_MODULES if m in sys.modules}
+
+    # called from the event loop and from workers
+    def mark(self, stage: str) -> None:
+        elapsed = time.perf_counter() - self.start
+        loaded = [m for m in HEAVY_MODULES if m in sys.modules and m not in self._seen]
+        self._seen.update(loaded)
+        self.marks.append((stage, elapsed, len(sys.modules), loaded))
+
+    def report(self) -> str:
+        lines = [f"{'stage':24s} {'ms':>9s} {'+ms':>9s} {'modules':>8s}  loaded"]
+        last = 0.0
+        for stage, elapsed, modules, loaded in self.marks:
+            lines.append(f"{stage:24s} {elapsed * 1000:9.1f} {(elapsed - last) * 1000:9.1f} {modules:8d}  {' '.join(loaded)}")
+            last = elapsed
+        return "\n".join(lines)
+
+tracer = Tracer()
+_NOOP = nullcontext({})
+
+if os.environ.get("VAULTIC_TRACE"):
+    tracer.enable(os.environ["VAULTIC_TRACE"])
+
+# a disabled tracer costs one attribute check
+def span(name: str, **attrs):
+    if not tracer.enabled:
+        return _NOOP
+    return tracer.span(name, **attrs)
+
+def traced(name: str):
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            if not tracer.enabled:
+                return fn(*args, **kwargs)
+            with tracer.span(name):
+                return fn(*args, **kwargs)
+        return inner
+    return wrap
@@ -1,11 +1,48 @@
+import base64
+import hashlib
+import hmac
 import json
 import os
-from dataclasses import dataclass
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field, replace
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Callable, ContextManager, Dict, Iterator, Optional, Sequence
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
-from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
-from .stego import extract, embed
+from .stego import extract, embed, extract_pixels, embed_pixels, capacity
+from .payload import MANIFEST_VERSION, Payload, pack, unpack, decode_plain, deflate_plain, dump_plain, encode_plain
+from . import history, journal
+from .shards import MAX_SHARDS, SHARD_WORKERS, StaleShard, shard_file, shard_for, sizes, sweep
+from .lock import writer_lock
+from .kdf import KdfParams, SALT_BYTES, derive_key, load_kdf, parse_salt, write_salt
+from .secret import scratch, wipe
+from .trace import span, traced
+
+INDEX_AAD = b"vaultic:index"
+RECORD_AAD = b"vaultic:record:"
+JOURNAL_AAD = b"vaultic:journal:"
+MANIFEST_AAD = b"vaultic:manifest"
+SHARD_AAD = b"vaultic:shard:"
+NONCE_BYTES = 12
+TAG_BYTES = 16
+# encrypt_into / decrypt_into, only in newer cryptography releases
+AEAD_INTO = hasattr(AESGCM, "decrypt_into")
+
+# past this the journal is folded back into the image on the next write
+COMPACT_BYTES = 256 * 1024
+# a reader that catches a writer between the image and journal swaps
+# tries again, after that the image alone is a consistent version
+READ_RETRIES = 5
+READ_RETRY_WAIT = 0.01
+# a cached read is trusted for this long even if the files never change
+STATE_TTL = 30.0
+
+# where the payload lives in vault.png, a tEXt chunk or the pixel lsbs
+CHUNK_MODE = "chunk"
+PIXEL_MODE = "pixels"
 
 @dataclass
 class VaultPaths:
@@ -13,6 +50,16 @@ class VaultPaths:
     vault_file: Path
     salt_file: Path
 
+    # changes not yet folded into vault_file, see journal.py
+    @property
+    def journal_file(self) -> Path:
+        return self.vault_file.with_suffix(".journal")
+
+    # held by writers, see lock.py
+    @property
+    def lock_file(self) -> Path:
+        return self.vault_file.with_suffix(".lock")
+
 # storing vault data and salt for encryption and key derivation
 def default() -> VaultPaths:
     base = Path.home() / ".vaultic"
@@ -22,105 +69,851 @@ def default() -> VaultPaths:
         salt_file=base / "salt.bin",
     )
 
+# salt written by a rekey that has not replaced salt.bin yet
+def pending_salt(paths: VaultPaths) -> Path:
+    return paths.salt_file.with_name(paths.salt_file.name + ".next")
+
 # create or load salt
 def load_salt(path: Path) -> bytes:
-    if path.exists():
-        return path.read_bytes()
-    salt = os.urandom(16)
-    path.parent.mkdir(parents=True, exist_ok=True)
-    path.write_bytes(salt)
-    return salt
-
-#32 bytesx key
-def derive_key(master_key: str, salt:bytes) -> bytes:
-    kdf = Scrypt(
-        salt=salt,
-        length=32,
-        n=2**14,
-        r=8,
-        p=1
-    )
-    return kdf.derive(master_key.encode("utf-8"))
+    return load_kdf(path)[0]
 
-def encrypt_json(data: Dict, key:bytes) -> bytes:
+def encrypt_json(data: Dict, key:bytes, aad: Optional[bytes] = None) -> bytes:
     aes=AESGCM(key)
     nonce=os.urandom(12)
     plaintext=json.dumps(data).encode("utf-8")
-    ciphertext=aes.encrypt(nonce, plaintext, associated_data=None)
+    ciphertext=aes.encrypt(nonce, plaintext, associated_data=aad)
     return nonce +ciphertext
 
 
-def decrypt_json(blob: bytes, key: bytes) -> Dict:
+def decrypt_json(blob: bytes, key: bytes, aad: Optional[bytes] = None) -> Dict:
     if len(blob) < 13:
         raise ValueError("vault data is too small")
     nonce, ciphertext = blob[:12], blob[12:]
     aes=AESGCM(key)
-    plaintext=aes.decrypt(nonce, ciphertext, associated_data=None)
+    plaintext=aes.decrypt(nonce, ciphertext, associated_data=aad)
     return json.loads(plaintext.decode("utf-8"))
 
 
+# like encrypt_json/decrypt_json but with the compact, optionally deflated
+# encoding from payload.py, used for every index and record
+# nonce + ciphertext + tag, encrypted straight into the one buffer returned.
+# the plaintext is wiped before returning (see secret.py)
+def seal(data: Dict, key: bytes, aad: bytes) -> bytearray:
+    return seal_plain(encode_plain(data), key, aad)
+
+
+# seals an already encoded plaintext and wipes it
+def seal_plain(plain: bytearray, key: bytes, aad: bytes) -> bytearray:
+    try:
+        aes = AESGCM(key)
+        nonce = os.urandom(NONCE_BYTES)
+        if not AEAD_INTO:
+            return bytearray(nonce) + aes.encrypt(nonce, plain, aad)
+        blob = bytearray(NONCE_BYTES + len(plain) + TAG_BYTES)
+        blob[:NONCE_BYTES] = nonce
+        aes.encrypt_into(nonce, plain, aad, memoryview(blob)[NONCE_BYTES:])
+        return blob
+    finally:
+        wipe(plain)
+
+
+# decrypts into this thread's scratch buffer, which is zeroed again as soon
+# as the plaintext is decoded
+def unseal(blob: bytes, key: bytes, aad: bytes) -> Dict:
+    if len(blob) < 13:
+        raise ValueError("vault data is too small")
+    if len(blob) < NONCE_BYTES + TAG_BYTES:
+        raise InvalidTag()
+    aes = AESGCM(key)
+    view = memoryview(blob)
+    nonce, sealed = view[:NONCE_BYTES], view[NONCE_BYTES:]
+    if not AEAD_INTO:
+        plain = bytearray(aes.decrypt(nonce, sealed, aad))
+        try:
+            return decode_plain(plain)
+        finally:
+            wipe(plain)
+    plain = scratch(len(sealed) - TAG_BYTES)
+    try:
+        aes.decrypt_into(nonce, sealed, aad, plain)
+        return decode_plain(plain)
+    finally:
+        wipe(plain)
+
+
+def new_entry_id() -> str:
+    return os.urandom(8).hex()
+
+
+# decrypted index plus the still sealed per entry records, with the
+# snapshot they were read from and how far its journal got
+@dataclass
+class VaultState:
+    index: Dict = field(default_factory=lambda: {"entries": {}})
+    records: Dict[str, bytes] = field(default_factory=dict)
+    base: bytes = b""
+    journal_seq: int = 0
+    journal_end: int = 0
+    # (ino, mtime, size) of the image and journal before they were read
+    stamp: tuple = ()
+    # how the image holds it, a vault served from the cache must be written
+    # back the same way
+    mode: str = CHUNK_MODE
+    # sharded vaults only: the manifest entry ({"file", "base"}) of each
+    # shard, the shard every entry is stored in, shards with changes not
+    # written yet and shards whose entries may still need moving to their
+    # home shard since shards were added
+    shards: list = field(default_factory=list)
+    placement: Dict[str, int] = field(default_factory=dict)
+    dirty: set = field(default_factory=set)
+    pending: list = field(default_factory=list)
+
+    # bumped by every committed change, never goes back
+    @property
+    def version(self) -> int:
+        return self.index.get("version", 0) + self.journal_seq
+
+    @property
+    def entries(self) -> Dict[str, Dict]:
+        return self.index.setdefault("entries", {})
+
+    # cached states are shared and never changed in place, a batch works on
+    # a copy. entry metas are replaced rather than edited so they can be shared
+    def copy(self) -> "VaultState":
+        index = dict(self.index)
+        index["entries"] = dict(self.entries)
+        return replace(
+            self,
+            index=index,
+            records=dict(self.records),
+            shards=[dict(ref) for ref in self.shards],
+            placement=dict(self.placement),
+            dirty=set(self.dirty),
+            pending=list(self.pending),
+        )
+
+
+# the last state read or written, reused while the image and journal keep the
+# same stat and it is younger than ttl, so reading an unchanged vault costs a
+# stat per file instead of an extract and decrypt. a session shares one
+# between every Vault it hands out and clears it when it locks
+class StateCache:
+
+    def __init__(self, ttl: float = STATE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entry: Optional[tuple] = None
+
+    def get(self, path: Path, key: bytes, stamp: tuple) -> Optional[VaultState]:
+        with self._lock:
+            if self._entry is None:
+                return None
+            cached_path, cached_key, state, expires = self._entry
+            if cached_path != path or state.stamp != stamp or time.monotonic() > expires:
+                return None
+            if not hmac.compare_digest(cached_key, key):
+                return None
+            return state
+
+    def put(self, path: Path, key: bytes, state: VaultState) -> None:
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entry = (path, key, state, time.monotonic() + self.ttl)
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._entry = None
+
+
 # encrypted vault stored in single file
 class Vault:
 
-    def __init__(self, master_key: str, paths: Optional[VaultPaths] = None):
+    def __init__(
+        self,
+        master_key: Optional[str] = None,
+        paths: Optional[VaultPaths] = None,
+        key: Optional[bytes] = None,
+        kdf: Optional[KdfParams] = None,
+        cache: Optional[StateCache] = None,
+        guard: Optional[Callable[[], ContextManager]] = None,
+    ):
         self.paths = paths or default()
         self.paths.dir.mkdir(parents=True, exist_ok=True)
 
-        salt = load_salt(self.paths.salt_file)
-        self.key = derive_key(master_key, salt)
+        # an already derived key (from a session) skips scrypt entirely
+        if key is None:
+            if master_key is None:
+                raise ValueError("a master password or derived key is required")
+            salt, kdf = load_kdf(self.paths.salt_file, kdf)
+            key = derive_key(master_key, salt, kdf)
+        elif kdf is None:
+            kdf = parse_salt(self.paths.salt_file.read_bytes())[1] if self.paths.salt_file.exists() else KdfParams()
+        self.key = key
+        self.kdf = kdf
+        self.mode = CHUNK_MODE
+        self.cache = cache if cache is not None else StateCache()
+        # held around everything that uses the key, a session's lock can't
+        # zero a key shared with this vault halfway through (see KeyHold)
+        self.guard = guard
+        # images new shards are first embedded in, see reshard()
+        self.covers: Sequence[str | Path] = ()
+        # how deep each thread is in _writer, another thread has to take the
+        # flock itself rather than ride on one it doesn't hold
+        self._held = threading.local()
 
-    def create_meme(self, cover_path: str | Path):
+    def create_meme(self, cover_path: str | Path, mode: str = CHUNK_MODE):
         if self.paths.vault_file.exists():
             raise FileExistsError(f"vault already exists at {self.paths.vault_file}, to overwrite this vault, manually delete the image at the provided path")
-        data = {"entries": {}}
-        blob = encrypt_json(data, self.key)
-        embed(cover_path, blob, self.paths.vault_file)
+        if mode not in (CHUNK_MODE, PIXEL_MODE):
+            raise ValueError(f"unknown vault mode {mode!r}")
+        blob = self._pack(VaultState())
+        if mode == PIXEL_MODE and capacity(cover_path) < len(blob):
+            raise ValueError("cover image is too small to hide a vault in its pixels")
+        self.mode = mode
+        self.cache.invalidate()
+        with self._writer():
+            self._embed(cover_path, blob)
+            # a journal left over from a deleted vault must not linger
+            journal.reset(self.paths.journal_file, journal.snapshot_id(blob))
+
+    def _pixel_seed(self) -> bytes:
+        seed = hashlib.sha256(b"vaultic:pixel-seed:")
+        seed.update(self.key)
+        return seed.digest()
+
+    @traced("vault.embed")
+    def _embed(self, cover_path: str | Path, blob: bytes) -> None:
+        if self.mode == PIXEL_MODE:
+            embed_pixels(cover_path, blob, self.paths.vault_file, self._pixel_seed())
+        else:
+            embed(cover_path, blob, self.paths.vault_file)
+
+    # the chunk is checked first since finding it costs a few header reads
+    @traced("vault.extract")
+    def _extract(self) -> Optional[bytes]:
+        blob = extract(self.paths.vault_file)
+        if blob is not None:
+            self.mode = CHUNK_MODE
+            return blob
+        blob = extract_pixels(self.paths.vault_file, self._pixel_seed())
+        if blob is not None:
+            self.mode = PIXEL_MODE
+        return blob
+
+    def _seal_record(self, entry_id: str, entry: Dict) -> bytes:
+        return seal(entry, self.key, RECORD_AAD + entry_id.encode("ascii"))
+
+    def _open_record(self, state: VaultState, service: str) -> Optional[Dict]:
+        meta = state.entries.get(service)
+        if meta is None:
+            return None
+        entry_id = meta["id"]
+        with span("aes.open_record"):
+            return unseal(state.records[entry_id], self.key, RECORD_AAD + entry_id.encode("ascii"))
+
+    # sealed like any record, only opened when history is asked for
+    def _open_history(self, state: VaultState, service: str) -> list:
+        meta = state.entries.get(service)
+        if meta is None or "history" not in meta:
+            return []
+        record_id = meta["history"]["id"]
+        with span("aes.open_history"):
+            return unseal(state.records[record_id], self.key, RECORD_AAD + record_id.encode("ascii"))["versions"]
+
+    def _pack(self, state: VaultState) -> bytes:
+        with span("aes.seal_index", entries=len(state.entries)):
+            index = seal(state.index, self.key, INDEX_AAD)
+        with span("payload.pack", records=len(state.records)):
+            return pack(Payload(index=index, records=state.records, kdf=self.kdf.as_tuple()))
+
+    # old vaults are one blob holding every entry, split them into index and
+    # records. the state has no base, so the next write (or compact) stores
+    # it in the new layout, readers never take the writer lock for it
+    def _migrate(self, data: Dict) -> VaultState:
+        state = VaultState()
+        now = int(time.time())
+        for service, entry in data.get("entries", {}).items():
+            entry_id = new_entry_id()
+            state.entries[service] = {"id": entry_id, "created": now, "updated": now}
+            state.records[entry_id] = self._seal_record(entry_id, entry)
+        return state
+
+    def _stamp(self) -> tuple:
+        stamp = ()
+        for path in (self.paths.vault_file, self.paths.journal_file):
+            try:
+                st = os.stat(path)
+                stamp += (st.st_ino, st.st_mtime_ns, st.st_size)
+            except FileNotFoundError:
+                stamp += (0, 0, 0)
+        return stamp
+
+    # writers hold the lock file for the whole read-check-write, nested calls
+    # on the same vault and thread reuse it. each flock opens its own fd, so
+    # two threads sharing a Vault wait on each other like two processes do
+    @contextmanager
+    def _writer(self) -> Iterator[None]:
+        depth = getattr(self._held, "depth", 0)
+        if depth:
+            self._held.depth = depth + 1
+            try:
+                yield
+            finally:
+                self._held.depth = depth
+            return
+        with self._using(), writer_lock(self.paths.lock_file):
+            self._held.depth = 1
+            try:
+                yield
+            finally:
+                self._held.depth = 0
 
-    def _read(self) -> Dict:
+    # lock free: the image is swapped in atomically and the journal names the
+    # image it belongs to, so a reader racing a writer either sees a whole
+    # version or notices the mismatch and reads again
+    @traced("vault.read")
+    def _read(self) -> VaultState:
+        state = None
+        for attempt in range(READ_RETRIES):
+            stamp = self._stamp()
+            try:
+                snapshot = self._read_snapshot()
+            except StaleShard:
+                time.sleep(READ_RETRY_WAIT)
+                continue
+            state = snapshot
+            state.stamp = stamp
+            state.mode = self.mode
+            try:
+                self._replay(state)
+                return state
+            except journal.StaleJournal:
+                time.sleep(READ_RETRY_WAIT)
+        if state is None:
+            raise ValueError("vault shards don't match the manifest in vault.png")
+        # a writer died between the two swaps, its image has everything
+        state.journal_seq = 0
+        state.journal_end = 0
+        return state
+
+    def _using(self) -> ContextManager:
+        return self.guard() if self.guard is not None else nullcontext()
+
+    # _read through the cache. the state returned is shared, use copy() before
+    # changing it
+    def _load(self) -> VaultState:
+        with self._using():
+            state = self.cache.get(self.paths.vault_file, self.key, self._stamp())
+            if state is None:
+                state = self._read()
+                self.cache.put(self.paths.vault_file, self.key, state)
+        self.mode = state.mode
+        return state
+
+    # what was just written is what the next read would find. only called
+    # under the writer lock, so nobody can change the files in between
+    def _cache_written(self, state: VaultState) -> None:
+        state.stamp = self._stamp()
+        state.mode = self.mode
+        self.cache.put(self.paths.vault_file, self.key, state)
+
+    def _read_snapshot(self) -> VaultState:
         if not self.paths.vault_file.exists():
             raise FileNotFoundError("vailt.png was not found")
-        blob = extract(self.paths.vault_file)
+        blob = self._extract()
         if blob is None:
-            raise ValueError("vault.png has no embedded vault data")
-       
-        return decrypt_json(blob, self.key)
-    
-    def _write(self, data: Dict) -> None:
+            # a pixel vault can only be found with the right key
+            raise ValueError("vault.png has no embedded vault data (or the master password is wrong)")
+
+        with span("payload.unpack", size=len(blob)):
+            payload = unpack(blob)
+        if payload is None:
+            return self._migrate(decrypt_json(blob, self.key))
+        if payload.version == MANIFEST_VERSION:
+            with span("aes.open_manifest"):
+                manifest = unseal(payload.index, self.key, MANIFEST_AAD)
+            state = self._read_shards(manifest)
+            state.base = journal.snapshot_id(blob)
+            return state
+        with span("aes.open_index"):
+            index = unseal(payload.index, self.key, INDEX_AAD)
+        return VaultState(index=index, records=payload.records, base=journal.snapshot_id(blob))
+
+    def _shard_aad(self, shard: int) -> bytes:
+        return SHARD_AAD + shard.to_bytes(2, "big")
+
+    def _shard_path(self, name: str) -> Path:
+        return self.paths.vault_file.parent / name
+
+    def _read_shard(self, shard: int, ref: Dict) -> tuple:
+        with span("vault.read_shard", shard=shard):
+            try:
+                blob = extract(self._shard_path(ref["file"]))
+            except FileNotFoundError:
+                raise StaleShard()
+            if blob is None or journal.snapshot_id(blob).hex() != ref["base"]:
+                raise StaleShard()
+            payload = unpack(blob)
+            index = unseal(payload.index, self.key, self._shard_aad(shard))
+        return index.get("entries", {}), payload.records
+
+    # every shard is extracted and decrypted on a thread of its own, the
+    # manifest pins the exact content of each so they can't be mixed up
+    def _read_shards(self, manifest: Dict) -> VaultState:
+        refs = manifest["shards"]
+        with ThreadPoolExecutor(max_workers=max(1, min(SHARD_WORKERS, len(refs)))) as pool:
+            parts = list(pool.map(self._read_shard, range(len(refs)), refs))
+        state = VaultState(
+            index={"entries": {}, "version": manifest.get("version", 0)},
+            shards=refs,
+            pending=manifest.get("pending", []),
+        )
+        for shard, (entries, records) in enumerate(parts):
+            state.entries.update(entries)
+            state.placement.update(dict.fromkeys(entries, shard))
+            state.records.update(records)
+        return state
+
+    # moves entries that sit on a pending shard but hash elsewhere, taking
+    # the first `sources` pending shards plus any that are rewritten anyway.
+    # returns how many entries moved
+    def _rebalance(self, state: VaultState, sources: Optional[int] = None) -> int:
+        todo = set(state.pending[:sources] if sources is not None else state.pending)
+        todo |= set(state.pending) & state.dirty
+        if not todo:
+            return 0
+        moved = 0
+        count = len(state.shards)
+        for service, shard in list(state.placement.items()):
+            if shard not in todo:
+                continue
+            home = shard_for(service, count)
+            if home != shard:
+                state.placement[service] = home
+                state.dirty.update((shard, home))
+                moved += 1
+        state.pending = [shard for shard in state.pending if shard not in todo]
+        return moved
+
+    def _shard_cover(self, shard: int, ref: Dict) -> Path | str:
+        if ref.get("file"):
+            return self._shard_path(ref["file"])
+        if self.covers:
+            return self.covers[shard % len(self.covers)]
+        return self.paths.vault_file
+
+    def _write_shard(self, shard: int, ref: Dict, entries: Dict, records: Dict) -> Dict:
+        with span("aes.seal_index", entries=len(entries), shard=shard):
+            index = seal({"entries": entries}, self.key, self._shard_aad(shard))
+        blob = pack(Payload(index=index, records=records, kdf=self.kdf.as_tuple()))
+        base = journal.snapshot_id(blob)
+        name = shard_file(self.paths.vault_file, shard, base)
+        embed(self._shard_cover(shard, ref), blob, self._shard_path(name))
+        return {"file": name, "base": base.hex()}
+
+    # writes the shards that changed (every shard with full) to new files
+    # and returns the manifest naming them, nothing is visible to readers
+    # until the manifest replaces vault.png. each write also moves the
+    # entries of one pending shard, so adding shards costs a little per write
+    def _pack_sharded(self, state: VaultState, full: bool = False) -> bytes:
+        self._rebalance(state, 1)
+        todo = [i for i, ref in enumerate(state.shards) if full or i in state.dirty or not ref.get("file")]
+        groups: Dict[int, tuple] = {i: ({}, {}) for i in todo}
+        for service, shard in state.placement.items():
+            group = groups.get(shard)
+            if group is not None:
+                meta = state.entries[service]
+                group[0][service] = meta
+                for record_id in record_ids(meta):
+                    group[1][record_id] = state.records[record_id]
+        with span("vault.write_shards", shards=len(todo)):
+            with ThreadPoolExecutor(max_workers=max(1, min(SHARD_WORKERS, len(todo)))) as pool:
+                refs = list(pool.map(
+                    lambda i: self._write_shard(i, state.shards[i], *groups[i]),
+                    todo,
+                ))
+        for i, ref in zip(todo, refs):
+            state.shards[i] = ref
+        state.dirty = set()
+        manifest = {"version": state.index.get("version", 0), "shards": state.shards, "pending": state.pending}
+        with span("aes.seal_manifest", shards=len(state.shards)):
+            index = seal(manifest, self.key, MANIFEST_AAD)
+        return pack(Payload(index=index, kdf=self.kdf.as_tuple(), version=MANIFEST_VERSION))
+
+    def _journal_aad(self, base: bytes, seq: int) -> bytes:
+        return JOURNAL_AAD + base + seq.to_bytes(4, "big")
+
+    # a last delta that fails to open was cut short by a crash, anything
+    # before it failing means the journal itself is damaged
+    @traced("journal.replay")
+    def _replay(self, state: VaultState) -> None:
+        frames, end = journal.read_frames(self.paths.journal_file, state.base)
+        state.journal_end = end
+        for seq, (offset, frame) in enumerate(frames):
+            try:
+                delta = unseal(frame, self.key, self._journal_aad(state.base, seq))
+            except (InvalidTag, ValueError):
+                if seq != len(frames) - 1:
+                    raise ValueError("vault journal is corrupted")
+                state.journal_end = offset
+                break
+            apply_delta(state, delta)
+            state.journal_seq = seq + 1
+
+    # the full snapshot carrying the version so far, then an empty journal
+    # for it. a sharded vault only rewrites the shards that changed unless
+    # full is set. callers hold the writer lock
+    @traced("vault.write")
+    def _write(self, state: VaultState, full: bool = False) -> None:
         if not self.paths.vault_file.exists():
             raise FileNotFoundError("vault.png not found")
 
-        blob = encrypt_json(data, self.key)
-        embed(self.paths.vault_file, blob, self.paths.vault_file)
+        state.index["version"] = state.version
+        blob = self._pack_sharded(state, full) if state.shards else self._pack(state)
+        self._embed(self.paths.vault_file, blob)
+        state.base = journal.snapshot_id(blob)
+        state.journal_seq = 0
+        state.journal_end = journal.reset(self.paths.journal_file, state.base)
+        if state.shards:
+            # readers still on the old manifest notice and read again
+            sweep(self.paths.vault_file, [ref["file"] for ref in state.shards])
+        self._cache_written(state)
+
+    # a pixel vault can't outgrow its cover and journaled changes still have
+    # to fit once folded, so a change the next snapshot wouldn't fit in is
+    # refused before anything is written. a sharded vault.png only holds the
+    # manifest, its shards are chunk images
+    def _check_room(self, state: VaultState, appended: int) -> None:
+        if self.mode != PIXEL_MODE or state.shards:
+            return
+        index = dict(state.index, version=state.version + appended)
+        need = len(self._pack(replace(state, index=index)))
+        room = capacity(self.paths.vault_file)
+        if need > room:
+            raise ValueError(f"vault needs {need} bytes but the cover only holds {room}")
+
+    # each delta is sealed on its own and appended with one fsync, a big
+    # enough journal (or batch) is written as a new snapshot instead. that is
+    # decided from the deltas' json before anything is deflated or sealed:
+    # its length bounds the frame, so this only errs towards snapshotting a
+    # little early
+    @traced("journal.append")
+    def _commit(self, state: VaultState, deltas: list) -> None:
+        self._check_room(state, len(deltas))
+        raws = [] if not state.base else [dump_plain(delta) for delta in deltas]
+        grown = state.journal_end + sum(journal.FRAME.size + NONCE_BYTES + len(raw) + TAG_BYTES for raw in raws)
+        if not state.base or grown > COMPACT_BYTES:
+            for raw in raws:
+                wipe(raw)
+            # the new snapshot counts these changes as if they were appended
+            state.journal_seq += len(deltas)
+            self._write(state)
+            return
+        frames = [
+            seal_plain(deflate_plain(raw), self.key, self._journal_aad(state.base, state.journal_seq + i))
+            for i, raw in enumerate(raws)
+        ]
+        state.journal_end = journal.append_frames(self.paths.journal_file, state.base, state.journal_end, frames)
+        state.journal_seq += len(frames)
+        self._cache_written(state)
+
+    # the changes were made against state, if someone else committed since,
+    # they are replayed on top of the newer version (last write wins per
+    # service) instead of overwriting it
+    def _rebase(self, state: VaultState, deltas: list) -> VaultState:
+        if self._stamp() == state.stamp:
+            return state
+        fresh = self._load()
+        if (fresh.version, fresh.base) == (state.version, state.base):
+            return state
+        fresh = fresh.copy()
+        with span("vault.rebase", deltas=len(deltas), behind=fresh.version - state.version):
+            for delta in deltas:
+                apply_delta(fresh, delta)
+        return fresh
+
+    # read once without locking, apply any number of changes in memory, then
+    # take the writer lock, rebase if needed and commit once
+    @contextmanager
+    def batch(self) -> Iterator["VaultBatch"]:
+        with self._using():
+            tx = VaultBatch(self, self._load().copy())
+            yield tx
+            if tx.dirty:
+                tx.trim_history()
+                with self._writer():
+                    tx.state = self._rebase(tx.state, tx.deltas)
+                    self._commit(tx.state, tx.deltas)
+
+    def journal_size(self) -> int:
+        return journal.size(self.paths.journal_file)
+
+    def version(self) -> int:
+        return self._load().version
+
+    # fold the journal back into the image, True if there was one (or force
+    # rewrites the image, and every shard, in the current layout regardless)
+    def compact(self, force: bool = False) -> bool:
+        with self._writer():
+            state = self._load()
+            if state.base and not state.journal_seq and not force:
+                return False
+            self._write(state.copy(), full=force)
+        return True
+
+    # (file, entries) per shard plus how many shards still wait for their
+    # entries to be rebalanced, ([], 0) for a single image vault
+    def shard_layout(self) -> tuple[list, int]:
+        state = self._load()
+        counts = sizes(state.placement, len(state.shards))
+        return [(ref.get("file", ""), n) for ref, n in zip(state.shards, counts)], len(state.pending)
+
+    # spread the entries over count images, or add shards to a sharded vault.
+    # going from one image writes every shard at once. when adding, only the
+    # new shards are written now and existing entries move to them a shard at
+    # a time on later writes, or all at once with rebalance()
+    def reshard(self, count: int, covers: Sequence[str | Path] = ()) -> None:
+        if not 2 <= count <= MAX_SHARDS:
+            raise ValueError(f"shard count must be between 2 and {MAX_SHARDS}")
+        with self._writer():
+            state = self._load().copy()
+            if self.mode == PIXEL_MODE:
+                raise ValueError("only chunk mode vaults can be sharded")
+            current = len(state.shards)
+            if count < current:
+                raise ValueError(f"the vault already has {current} shards, shards can only be added")
+            if count == current:
+                return
+            self.covers = covers
+            try:
+                if current:
+                    state.pending = sorted(set(state.pending) | set(range(current)))
+                    state.shards += [{} for _ in range(count - current)]
+                    self._write(state)
+                else:
+                    state.shards = [{} for _ in range(count)]
+                    state.placement = {service: shard_for(service, count) for service in state.entries}
+                    self._write(state, full=True)
+            finally:
+                self.covers = ()
+
+    # finish moving entries onto their home shards, returns how many moved
+    def rebalance(self) -> int:
+        with self._writer():
+            state = self._load()
+            if not state.pending:
+                return 0
+            state = state.copy()
+            moved = self._rebalance(state)
+            self._write(state)
+        return moved
 
     def add_entry(self, service: str, password: str) -> None:
-        service = service.strip().lower()
-        data = self._read()
-        data.setdefault("entries", {})
-        data["entries"][service] = {"password": password}
-        self._write(data)
+        with self.batch() as tx:
+            tx.add(service, password)
     
     def update_entry(self, service: str, password: str):
         self.add_entry(service, password)
     
     def delete_entry(self, service: str) -> bool:
-        service = service.strip().lower()
-        data = self._read()
-        entries = data.get("entries", {})
-        if service not in entries:
-            return False
-        del entries[service]
-        data["entries"] = entries
-        self._write(data)
-        return True
+        with self.batch() as tx:
+            return tx.delete(service)
 
     def get_entry(self, service: str) -> Optional[Dict]:
         service = service.strip().lower()
-        data = self._read()
-        return data.get("entries", {}).get(service)
+        with self._using():
+            return self._open_record(self._load(), service)
+
+    # earlier passwords, newest first: {"password", "set", "replaced"}
+    def history(self, service: str) -> list[Dict]:
+        with self._using():
+            return self._open_history(self._load(), service.strip().lower())
+
+    # makes the n-th earlier password current again, the current one goes
+    # into the history. False if there is no such version
+    def restore(self, service: str, n: int) -> bool:
+        with self.batch() as tx:
+            return tx.restore(service, n)
     
     def list_services(self) -> list[str]:
-        data=self._read()
-        return sorted(list(data.get("entries", {}).keys()))
+        return sorted(self._load().entries)
 
+    # a cache hit counts, it only matches a key that opened this vault before
     def verify_master(self) -> None:
-        _ = self._read()
\ No newline at end of file
+        _ = self._load()
+
+    # re-derive under a fresh salt, new params and/or a new master and re-seal
+    # the index and every record in one write. the new salt goes to a pending
+    # file first and only replaces salt.bin once the vault is written, an
+    # interrupted rekey is finished by the next unlock (see VaultSession)
+    def rekey(self, master_key: str, kdf: Optional[KdfParams] = None) -> bytes:
+        with self._writer():
+            return self._rekey(master_key, kdf)
+
+    def _rekey(self, master_key: str, kdf: Optional[KdfParams]) -> bytes:
+        state = self._load()
+        entries = {entry_id: unseal(blob, self.key, RECORD_AAD + entry_id.encode("ascii")) for entry_id, blob in state.records.items()}
+
+        kdf = kdf or self.kdf
+        salt = os.urandom(SALT_BYTES)
+        new_key = derive_key(master_key, salt, kdf)
+        pending = pending_salt(self.paths)
+        write_salt(pending, salt, kdf)
+
+        old = (self.key, self.kdf)
+        self.key, self.kdf = new_key, kdf
+        try:
+            records = {entry_id: self._seal_record(entry_id, entry) for entry_id, entry in entries.items()}
+            index = dict(state.index, version=state.version + 1)
+            rekeyed = replace(state.copy(), index=index, records=records, journal_seq=0)
+            self._write(rekeyed, full=True)
+        except BaseException:
+            self.key, self.kdf = old
+            wipe(new_key)
+            pending.unlink(missing_ok=True)
+            raise
+        os.replace(pending, self.paths.salt_file)
+        return new_key
+
+
+
+# every sealed record an entry owns: its current value and its history
+def record_ids(meta: Dict) -> list:
+    if "history" in meta:
+        return [meta["id"], meta["history"]["id"]]
+    return [meta["id"]]
+
+
+# journal deltas: the new index entry plus its sealed record (and history
+# record when it changed), or a removal
+def apply_delta(state: VaultState, delta: Dict) -> None:
+    service = delta["service"]
+    old = state.entries.pop(service, None)
+    dropped = {}
+    if old is not None:
+        dropped = {record_id: state.records.pop(record_id, None) for record_id in record_ids(old)}
+    if delta["op"] == "put":
+        meta = dict(delta["meta"])
+        state.entries[service] = meta
+        state.records[meta["id"]] = base64.b64decode(delta["record"])
+        kept = meta.get("history")
+        if "history" in delta:
+            state.records[kept["id"]] = base64.b64decode(delta["history"])
+        elif kept is not None and dropped.get(kept["id"]) is not None:
+            state.records[kept["id"]] = dropped[kept["id"]]
+        elif kept is not None:
+            # rebased onto a version whose history moved on, keep that one
+            del meta["history"]
+            if old is not None and "history" in old:
+                meta["history"] = old["history"]
+                state.records[old["history"]["id"]] = dropped[old["history"]["id"]]
+    place(state, service, delta["op"] == "put")
+
+
+# keeps a sharded state's placement in step with a change to service: it
+# leaves whatever shard held it and, unless deleted, lands on its home shard
+def place(state: VaultState, service: str, present: bool) -> None:
+    if not state.shards:
+        return
+    old = state.placement.pop(service, None)
+    if old is not None:
+        state.dirty.add(old)
+    if present:
+        home = shard_for(service, len(state.shards))
+        state.placement[service] = home
+        state.dirty.add(home)
+
+
+# pending changes against one read of the vault, see Vault.batch()
+class VaultBatch:
+
+    def __init__(self, vault: Vault, state: VaultState):
+        self.vault = vault
+        self.state = state
+        self.deltas: list[Dict] = []
+        self._history_changed = False
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self.deltas)
+
+    # replaces the history record of meta with versions, returns it encoded
+    # for the delta (None once the history is empty)
+    def _set_history(self, meta: Dict, versions: list) -> Optional[str]:
+        old = meta.pop("history", None)
+        if old is not None:
+            self.state.records.pop(old["id"], None)
+        self._history_changed = True
+        if not versions:
+            return None
+        record_id = old["id"] if old is not None else new_entry_id()
+        record = self.vault._seal_record(record_id, {"versions": versions})
+        self.state.records[record_id] = record
+        meta["history"] = history.summary(record_id, versions)
+        return base64.b64encode(record).decode("ascii")
+
+    def _put(self, service: str, meta: Dict, history_blob: Optional[str]) -> None:
+        self.state.entries[service] = meta
+        place(self.state, service, True)
+        record = self.state.records[meta["id"]]
+        delta = {"op": "put", "service": service, "meta": dict(meta), "record": base64.b64encode(record).decode("ascii")}
+        if history_blob is not None:
+            delta["history"] = history_blob
+        self.deltas.append(delta)
+
+    # a changed password pushes the one it replaces onto the entry's history
+    def add(self, service: str, password: str) -> None:
+        service = service.strip().lower()
+        now = int(time.time())
+        old = self.state.entries.get(service)
+        meta = dict(old or {"id": new_entry_id(), "created": now})
+        history_blob = None
+        if old is not None:
+            current = self.vault._open_record(self.state, service)["password"]
+            if current != password:
+                versions = history.push(self.history(service), current, old.get("updated", old["created"]), now, password)
+                history_blob = self._set_history(meta, versions)
+        meta["updated"] = now
+        self.state.records[meta["id"]] = self.vault._seal_record(meta["id"], {"password": password})
+        self._put(service, meta, history_blob)
+
+    def update(self, service: str, password: str) -> None:
+        self.add(service, password)
+
+    def delete(self, service: str) -> bool:
+        meta = self.state.entries.pop(service.strip().lower(), None)
+        if meta is None:
+            return False
+        for record_id in record_ids(meta):
+            self.state.records.pop(record_id, None)
+        place(self.state, service.strip().lower(), False)
+        self.deltas.append({"op": "del", "service": service.strip().lower()})
+        return True
+
+    def get(self, service: str) -> Optional[Dict]:
+        return self.vault._open_record(self.state, service.strip().lower())
+
+    def history(self, service: str) -> list[Dict]:
+        return self.vault._open_history(self.state, service.strip().lower())
+
+    def restore(self, service: str, n: int) -> bool:
+        versions = self.history(service)
+        if not 0 <= n < len(versions):
+            return False
+        self.add(service, versions[n]["password"])
+        return True
+
+    # the vault wide history limit, applied once when the batch commits and
+    # only if it added history
+    def trim_history(self) -> None:
+        if not self._history_changed:
+            return
+        trimmed = history.trim(self.state.entries, self.history)
+        for service, versions in trimmed.items():
+            meta = dict(self.state.entries[service])
+            self._put(service, meta, self._set_history(meta, versions))
+        self._history_changed = False
+
+    def services(self) -> list[str]:
+        return sorted(self.state.entries)